@@ -4,153 +4,424 @@
 
 """Charmed Operator to deploy Parca Agent."""
 
+import functools
+import hashlib
+import json
 import logging
-from typing import Dict, Optional
+import os
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Set, Type, cast
 
 import ops
-from charms.certificate_transfer_interface.v1.certificate_transfer import (
-    CertificateTransferRequires,
-)
-from charms.grafana_agent.v0.cos_agent import COSAgentProvider, charm_tracing_config
 from charms.operator_libs_linux.v1 import snap
 from charms.parca_k8s.v0.parca_store import (
     ParcaStoreEndpointRequirer,
 )
-from charms.tempo_coordinator_k8s.v0.charm_tracing import trace_charm
 
-from parca_agent import ParcaAgent
+from parca_agent import AgentState, ParcaAgent
+
+if TYPE_CHECKING:
+    from charms.certificate_transfer_interface.v1.certificate_transfer import (
+        CertificateTransferRequires,
+    )
 
 logger = logging.getLogger(__name__)
 
+# Even if the desired state is unchanged, fully reconcile at least this often (in seconds),
+# to correct any drift of the workload from it.
+FULL_RECONCILE_INTERVAL = 60 * 60
+# The parts of the desired state of Parca Agent that are reconciled separately, each on the
+# events of the relation that provides its inputs.
+RECONCILE_SCOPES = ("certificates", "store")
+# Marks, in the charm directory, that the unit was related to a COS agent as of the last hook.
+# Only then is the charm traced: charm tracing imports the opentelemetry SDK, which every hook
+# would otherwise pay for at dispatch, with nowhere to send the traces to.
+TRACING_MARKER = ".cos-agent-related"
+
+
+@functools.lru_cache(maxsize=None)
+def _traced(cls: type) -> type:
+    """Instrument a type imported lazily, as `trace_charm` does for its `extra_types`.
+
+    Cached, so that instantiating the charm again in the same process doesn't wrap it twice.
+    """
+    from charms.tempo_coordinator_k8s.v0.charm_tracing import trace_type
+
+    return trace_type(cls)
+
 
-@trace_charm(
-    tracing_endpoint="charm_tracing_endpoint",
-    extra_types=(
-        ParcaAgent,
-        COSAgentProvider,
-        ParcaStoreEndpointRequirer,
-        CertificateTransferRequires,
-    ),
-)
 class ParcaAgentOperatorCharm(ops.CharmBase):
     """Charmed Operator to deploy Parca - a continuous profiling tool."""
 
+    _stored = ops.StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
+        self._stored.set_default(
+            parca_agent={},
+            workload_version=None,
+            # the fingerprint of the inputs of each scope, when it was last reconciled
+            reconciled_fingerprints={},
+            reconciled_at=0.0,
+            # the open ports we set, to skip setting them again
+            ports=None,
+            # update-status hooks processed, to deep check the agent every so many of them
+            update_status_count=0,
+        )
 
         # Enable the option to send profiles to a remote store (i.e. Polar Signals Cloud)
         self._store_requirer = ParcaStoreEndpointRequirer(self)
-        self._cert_transfer = CertificateTransferRequires(self, "receive-ca-cert")
+        self._cert_transfer = self._init_cert_transfer()
 
         # Enable COS Agent
-        self._cos_agent = COSAgentProvider(
-            self,
-            metrics_endpoints=[{"path": "/metrics", "port": 7071}],
-            # Currently, parca-agent snap doesn't expose a slot to access its logs.
-            # https://github.com/parca-dev/parca-agent/issues/3017
-            log_slots=None,
-            tracing_protocols=["otlp_http"],
-        )
-        self.charm_tracing_endpoint, _ = charm_tracing_config(self._cos_agent, None)
+        self.charm_tracing_endpoint = self._init_cos_agent()
 
         # === WORKLOADS === #
         self.parca_agent = ParcaAgent(
-            self.app.name, self._store_config, self._cert_transfer.get_all_certificates()
+            self.app.name,
+            self._store_config,
+            self._get_certificates,
+            state=self._stored.parca_agent,
+            snap_change_timeout=cast(int, self.config["snap-change-timeout"]),
+            restart_debounce=cast(int, self.config["restart-debounce"]),
         )
 
         # === EVENT HANDLER REGISTRATION === #
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
         self.framework.observe(self.on.start, self._on_start)
+        self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.remove, self._on_remove)
         self.framework.observe(self.on.collect_unit_status, self._on_collect_unit_status)
+        self.framework.observe(self.on.reconcile_action, self._on_reconcile_action)
+        for event in (
+            self.on["receive-ca-cert"].relation_changed,
+            self.on["receive-ca-cert"].relation_broken,
+        ):
+            self.framework.observe(event, self._on_certificates_changed)
+        for event in (
+            self.on["parca-store-endpoint"].relation_changed,
+            self.on["parca-store-endpoint"].relation_broken,
+        ):
+            self.framework.observe(event, self._on_store_changed)
+
+        self._track_snap_change()
+        self._restart_if_due()
+
+    # === INTEGRATIONS === #
+    # The libraries behind these integrations (pydantic, cosl) are expensive to import, and
+    # most hooks on an unrelated unit don't need them: only load them when the relation they
+    # serve is there. As they aren't in `trace_charm`'s `extra_types`, trace them on load, if
+    # the charm is traced.
+    def _init_cert_transfer(self) -> Optional["CertificateTransferRequires"]:
+        """Set up the certificate transfer requirer, if CA certificates may be received."""
+        if not self.model.relations["receive-ca-cert"]:
+            return None
+
+        from charms.certificate_transfer_interface.v1.certificate_transfer import (
+            CertificateTransferRequires,
+        )
+
+        requirer_type = CertificateTransferRequires
+        if self.model.relations["cos-agent"]:
+            requirer_type = _traced(requirer_type)
+        return requirer_type(self, "receive-ca-cert")
+
+    def _get_certificates(self) -> Set[str]:
+        """Get all CA certificates received.
 
-        self._reconcile()
+        Parsing them is not cheap: this is only called if the CA bundle is to be reconciled.
+        """
+        if not self._cert_transfer:
+            return set()
+        return self._cert_transfer.get_all_certificates()
+
+    @property
+    def _certificates_digest(self) -> Optional[str]:
+        """A digest of all CA certificates received, which changes along with them.
+
+        It is taken from the raw relation data, which is much cheaper than parsing it: equal
+        digests mean the certificates are unchanged, different ones that they may have changed.
+        """
+        if not self._cert_transfer:
+            return None
+        digest = hashlib.sha256()
+        relations = self.model.relations["receive-ca-cert"]
+        for relation in sorted(relations, key=lambda relation: relation.id):
+            if not relation.active or not relation.app:
+                continue
+            certificates = relation.data[relation.app].get("certificates", "")
+            digest.update(f"{relation.id}\0{certificates}\0".encode())
+            if certificates in ("", "[]"):
+                # v0 providers share their certificates in their units' databags
+                for unit in sorted(relation.units, key=lambda unit: unit.name):
+                    chain = relation.data[unit].get("chain", "")
+                    digest.update(f"{unit.name}\0{chain}\0".encode())
+        return digest.hexdigest()
+
+    def _init_cos_agent(self) -> Optional[str]:
+        """Set up the COS agent provider, returning the charm tracing endpoint, if any."""
+        marker = self.charm_dir / TRACING_MARKER
+        if not self.model.relations["cos-agent"]:
+            marker.unlink(missing_ok=True)
+            return None
+        # trace the hooks from the next one on
+        marker.touch()
+
+        from charms.grafana_agent.v0.cos_agent import COSAgentProvider, charm_tracing_config
+
+        self._cos_agent = _traced(COSAgentProvider)(
+            self,
+            metrics_endpoints=[{"path": "/metrics", "port": 7071}],
+            # Currently, parca-agent snap doesn't expose a slot to access its logs.
+            # https://github.com/parca-dev/parca-agent/issues/3017
+            log_slots=None,
+            tracing_protocols=["otlp_http"],
+        )
+        endpoint, _ = charm_tracing_config(self._cos_agent, None)
+        return endpoint
 
     # === RECONCILERS === #
-    def _reconcile(self):
-        """Event-independent logic."""
-        if self.parca_agent.installed:
-            self.parca_agent.reconcile()
-            self.unit.set_workload_version(self.parca_agent.version)
+    def _reconcile(
+        self, agent: AgentState, scopes: Sequence[str] = RECONCILE_SCOPES, force: bool = False
+    ) -> List[str]:
+        """Reconcile the given scopes of the desired state of Parca Agent.
+
+        Each scope is skipped if its inputs are the ones it was last reconciled with. All of
+        them are reconciled, whatever their inputs, if forced, if the snap changed since, or if
+        a periodic full reconcile is due.
+
+        Returns the inputs which changed.
+        """
+        # without a store, parca-agent has nowhere to send profiles to: there's nothing to do
+        if not agent.installed or self.parca_agent.change_in_progress or not self._store_config:
+            return []
+
+        reconciled = self._stored.reconciled_fingerprints
+        full = (
+            force
+            or not reconciled
+            or time.time() - self._stored.reconciled_at >= FULL_RECONCILE_INTERVAL
+        )
+        desired = {
+            scope: self._desired_state_fingerprint(scope)
+            for scope in (RECONCILE_SCOPES if full else scopes)
+        }
+        stale = [scope for scope in desired if full or desired[scope] != reconciled.get(scope)]
+        if not stale:
+            return []
+
+        changed = self.parca_agent.reconcile(
+            certificates="certificates" in stale, store="store" in stale
+        )
+        for scope in stale:
+            reconciled[scope] = desired[scope]
+        if full:
+            self._stored.reconciled_at = time.time()
+        return changed
+
+    def _desired_state_fingerprint(self, scope: str) -> str:
+        """Compute a stable hash of the inputs a scope of the reconcile logic depends on."""
+        inputs = self._certificates_digest if scope == "certificates" else self._store_config
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _invalidate_reconciled_state(self):
+        """Fully reconcile in the next hook that reconciles, e.g. after the snap was changed."""
+        self._stored.reconciled_fingerprints = {}
+
+    def _set_workload_version(self, version: str):
+        """Set the workload version, unless it is the one we already set in an earlier hook."""
+        if version != self._stored.workload_version:
+            self.unit.set_workload_version(version)
+            self._stored.workload_version = version
+
+    def _restart_if_due(self, force: bool = False):
+        """Carry out a debounced restart of parca-agent, once its window has closed."""
+        if self.parca_agent.restart_pending and self.parca_agent.installed:
+            self.parca_agent.restart_if_due(force)
+
+    def _track_snap_change(self):
+        """Follow up on a snap install or refresh that outlived the hook which started it."""
+        try:
+            self.parca_agent.track_change()
+        except snap.SnapError as e:
+            logger.error("Failed to install or refresh parca-agent snap %s", str(e))
+
+    def _set_ports(self, *ports: int):
+        """Open the given TCP ports, closing any others, unless they already are the ones we set."""
+        if sorted(ports) != self._stored.ports:
+            self.unit.set_ports(*ports)
+            self._stored.ports = sorted(ports)
+
+    def _snap_resource(self) -> Optional[Path]:
+        """Get the parca-agent snap resource, to install the snap from, if one is attached."""
+        try:
+            resource = self.model.resources.fetch("parca-agent-snap")
+        except ops.ModelError:
+            return None
+        # Charmhub serves an empty file for resources which weren't uploaded
+        return resource if resource.stat().st_size else None
 
     # === STORE CONFIG === #
-    @property
+    @functools.cached_property
     def _store_config(self) -> Optional[Dict[str, str]]:
+        # relation data doesn't change within a hook: read it once
         return self._store_requirer.config
 
     # === EVENT HANDLERS === #
     def _on_install(self, _):
         """Install dependencies for Parca Agent and ensure initial configs are written."""
         self.unit.status = ops.MaintenanceStatus("installing parca-agent")
+        self._invalidate_reconciled_state()
         try:
-            self.parca_agent.install()
+            self.parca_agent.install(self._snap_resource())
         except snap.SnapError as e:
             logger.exception("Failed to install parca-agent snap %s", str(e))
 
     def _on_upgrade_charm(self, _):
         """Ensure the snap is refreshed (in channel) if there are new revisions."""
         self.unit.status = ops.MaintenanceStatus("refreshing parca-agent")
+        self._invalidate_reconciled_state()
         try:
-            self.parca_agent.refresh()
+            self.parca_agent.refresh(self._snap_resource())
         except snap.SnapError as e:
             logger.exception("Failed to refresh parca-agent snap %s", str(e))
+        self._reconcile(self.parca_agent.observed_state, force=True)
 
-    def _on_start(self, _):
+    def _on_start(self, event: ops.StartEvent):
         """Start Parca Agent."""
+        if self.parca_agent.change_in_progress:
+            # the snap isn't there yet: start once snapd is done installing it
+            event.defer()
+            return
+        self._reconcile(self.parca_agent.observed_state)
+        # snapd already started parca-agent when installing it: have it pick up its config now,
+        # rather than profiling without it until the restart debounce window closes
+        self._restart_if_due(force=True)
         self.parca_agent.start()
-        self.unit.set_ports(7071)
+        self._set_ports(7071)
+
+    def _on_update_status(self, _):
+        """Check the health of Parca Agent, and carry out any debounced restart of it.
+
+        Every update-status, the agent is cheaply probed. Only every `deep-check-interval`
+        update-status, or if the probe failed, is it checked in depth: held, and fully
+        reconciled, whether its inputs seem to have changed or not.
+        """
+        agent = self.parca_agent.observed_state
+        self._stored.update_status_count += 1
+        interval = max(cast(int, self.config["deep-check-interval"]), 1)
+        deep = self._stored.update_status_count % interval == 0 or (
+            agent.installed and not self.parca_agent.probe()
+        )
+        if deep and agent.installed and not self.parca_agent.change_in_progress:
+            self.parca_agent.ensure_held()
+        self._reconcile(agent, scopes=(), force=deep)
+        self._restart_if_due(force=True)
+
+    def _on_certificates_changed(self, _):
+        """Reconcile the CA certificates trusted by Parca Agent."""
+        self._reconcile(self.parca_agent.observed_state, scopes=("certificates",))
+        self._restart_if_due()
+
+    def _on_store_changed(self, _):
+        """Reconcile the remote store Parca Agent sends profiles to."""
+        self._reconcile(self.parca_agent.observed_state, scopes=("store",))
+        self._restart_if_due()
+
+    def _on_reconcile_action(self, event: ops.ActionEvent):
+        """Fully reconcile Parca Agent, whether its inputs seem to have changed or not."""
+        if change_in_progress := self.parca_agent.change_in_progress:
+            event.fail(f"parca-agent snap {change_in_progress}")
+            return
+        if not self.parca_agent.observed_state.installed:
+            event.fail("The parca-agent snap is not installed")
+            return
+        if not self._store_config:
+            event.fail("No store configured")
+            return
+        changed = self._reconcile(self.parca_agent.observed_state, force=True)
+        event.set_results({"changed": ", ".join(changed) or "nothing"})
 
     def _on_remove(self, _):
         """Remove Parca Agent from the machine."""
         self.unit.status = ops.MaintenanceStatus("removing parca-agent")
+        self._invalidate_reconciled_state()
         self.parca_agent.remove()
 
     def _on_collect_unit_status(self, event: ops.CollectStatusEvent):
-        """Set unit status depending on the state."""
+        """Set unit status depending on the state, unless the unit already has that status.
+
+        The workload version is reported along with it, whether the unit is blocked or not.
+        """
+        agent = self.parca_agent.observed_state
+        if agent.installed:
+            self._set_workload_version(cast(str, agent.version))
+        status = self._unit_status(agent)
+        # compare with the status Juju has, not one kept in stored state: a hook which fails
+        # rolls its stored state back, but not the status it set
+        if status != self.unit.status:
+            event.add_status(status)
+
+    def _unit_status(self, agent: AgentState) -> ops.StatusBase:
+        """Work out the unit status from the observed state of Parca Agent."""
         # by most to least serious issue with the snap, report a blocked status
         if not self._store_config:
-            event.add_status(
-                ops.BlockedStatus(
-                    "No store configured; relate with a `parca_store` provider to start "
-                    "sending profiles to a parca backend."
-                )
+            return ops.BlockedStatus(
+                "No store configured; relate with a `parca_store` provider to start "
+                "sending profiles to a parca backend."
             )
-        elif not self.parca_agent.installed:
-            event.add_status(
-                ops.BlockedStatus(
-                    "The parca-agent snap is not installed. "
-                    "Check `juju debug-log` for errors during the setup phase."
-                )
+        if change_in_progress := self.parca_agent.change_in_progress:
+            return ops.MaintenanceStatus(f"parca-agent snap {change_in_progress}")
+        if not agent.installed:
+            return ops.BlockedStatus(
+                "The parca-agent snap is not installed. "
+                "Check `juju debug-log` for errors during the setup phase."
             )
 
         # set to blocked if the snap failed to start.
         # it might happen that the snap would take some time before it becomes "inactive".
         # if this happens, the charm will be set to blocked in the next processed event.
         # https://github.com/canonical/parca-agent-operator/issues/56
-        elif not self.parca_agent.running:
-            event.add_status(
-                ops.BlockedStatus(
-                    f"The parca-agent snap is not running. "
-                    f"Check `juju ssh -m {self.model.name} {self.unit.name} sudo snap logs parca-agent` "
-                    f"for errors."
-                )
+        if not agent.active:
+            return ops.BlockedStatus(
+                f"The parca-agent snap is not running. "
+                f"Check `juju ssh -m {self.model.name} {self.unit.name} sudo snap logs parca-agent` "
+                f"for errors."
             )
+        if download_in_progress := self.parca_agent.download_in_progress:
+            return ops.MaintenanceStatus(f"parca-agent snap {download_in_progress}")
         # We'll only hit the below case if the snap is already installed,
         # but couldn't be refreshed during the upgrade-charm event
-        elif (target_revision := self.parca_agent.target_revision) != (
-            current_revision := self.parca_agent.revision
+        if (target_revision := self.parca_agent.target_revision) != (
+            current_revision := agent.revision
         ):
-            event.add_status(
-                ops.BlockedStatus(
-                    f"The snap revision {target_revision!r} doesn't match the expected value {current_revision!r}, "
-                    f"hinting at an upgrade error."
-                    "Check `juju debug-log` for errors."
-                )
+            return ops.BlockedStatus(
+                f"The snap revision {target_revision!r} doesn't match the expected value {current_revision!r}, "
+                f"hinting at an upgrade error."
+                "Check `juju debug-log` for errors."
             )
+        if self.parca_agent.restart_pending:
+            return ops.WaitingStatus("restart pending")
+        return ops.ActiveStatus("")
+
+
+def _charm_type(charm_dir: Path) -> Type[ops.CharmBase]:
+    """Return the charm type to dispatch a hook to: traced if related to a COS agent."""
+    if not (charm_dir / TRACING_MARKER).exists():
+        return ParcaAgentOperatorCharm
+
+    from charms.tempo_coordinator_k8s.v0.charm_tracing import trace_charm
 
-        event.add_status(ops.ActiveStatus(""))
+    return trace_charm(
+        tracing_endpoint="charm_tracing_endpoint",
+        extra_types=(
+            ParcaAgent,
+            ParcaStoreEndpointRequirer,
+        ),
+    )(ParcaAgentOperatorCharm)
 
 
 if __name__ == "__main__":  # pragma: nocover
-    ops.main(ParcaAgentOperatorCharm)
+    ops.main(_charm_type(Path(os.environ.get("JUJU_CHARM_DIR", Path(__file__).parents[1]))))
@@ -3,27 +3,58 @@
 
 """Control Parca Agent on a host system. Provides a Parca Agent class."""
 
+import base64
+import contextlib
+import functools
+import hashlib
+import json
 import logging
-import platform
+import math
+import os
+import shutil
+import signal
 import subprocess
+import tarfile
+import tempfile
+import time
+import urllib.request
+from dataclasses import dataclass, field
 from pathlib import Path
 from subprocess import CalledProcessError, check_output
-from typing import Dict, Optional, Set, Tuple, cast
+from typing import Any, Callable, Dict, List, MutableMapping, Optional, Set, Tuple, Union, cast
 
 from charms.operator_libs_linux.v1 import snap
 
+import snap_client
+
 logger = logging.getLogger(__name__)
 
+# where earlier revisions of this charm installed CA certificates, system-wide
 CA_CERTS_PATH = Path("/usr/local/share/ca-certificates")
-
-
+# where the CA bundle linked into SYSTEM_CERTS_DIR is kept: the data directory of the snap
+CA_BUNDLE_DIR = Path("/var/snap/parca-agent/common")
+# like any Go program on the host (jujud, snapd, ...), parca-agent trusts all certificate files
+# in this directory, while OpenSSL-based programs only look up the files named after a
+# certificate hash
+SYSTEM_CERTS_DIR = Path("/etc/ssl/certs")
+# where the parca-agent snaps unpacked from the charm resource are kept, by revision
+SNAP_CACHE_DIR = Path("/var/cache/charm-parca-agent")
+# give up on a snap downloaded in the background after this long (in seconds), and refresh
+# from the store instead
+DOWNLOAD_TIMEOUT = 60 * 60
+# where parca-agent serves its metrics, which the health probe checks it responds on
+METRICS_URL = "http://localhost:7071/metrics"
+
+
+@functools.lru_cache(maxsize=None)
 def get_system_arch() -> str:
     """Return the architecture of this machine, mapping some values to amd64 or arm64.
 
     If platform is x86_64 or amd64, it returns amd64.
     If platform is aarch64, arm64, armv8b, or armv8l, it returns arm64.
     """
-    arch = platform.processor()
+    # unlike `platform.processor()`, this doesn't spawn `uname -p`, which may report "unknown"
+    arch = os.uname().machine
     if arch in ["x86_64", "amd64"]:
         arch = "amd64"
     elif arch in ["aarch64", "arm64", "armv8b", "armv8l"]:
@@ -41,116 +72,664 @@ class SnapSpecError(snap.SnapError):
     pass
 
 
+class SnapResourceError(snap.SnapError):
+    """Custom exception type for a snap resource which can't be installed."""
+
+    pass
+
+
+@dataclass
+class ReconcilePlan:
+    """Changes to bring Parca Agent to its desired state, applied with a single restart."""
+
+    # the new combined CA file contents, or "" to remove it (None if unchanged)
+    ca_bundle: Optional[str] = None
+    # the snap config keys to change, and their new values
+    config: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def reasons(self) -> List[str]:
+        """The inputs which changed, and require a restart."""
+        reasons = []
+        if self.ca_bundle is not None:
+            reasons.append("CA certificates")
+        if self.config:
+            reasons.append(f"store config ({', '.join(sorted(self.config))})")
+        return reasons
+
+
+@dataclass
+class InstallPlan:
+    """snapd operations to bring the Parca Agent snap to its desired revision, held."""
+
+    # the revision to install or refresh to (None if already installed)
+    revision: Optional[int] = None
+    # the charm resource to install it from, rather than the store
+    resource: Optional[Path] = None
+    # whether to download it before refreshing, rather than as part of the refresh
+    prestage: bool = False
+    hold: bool = False
+
+    @property
+    def steps(self) -> List[str]:
+        """The operations to run, in order."""
+        steps = []
+        if self.revision is not None:
+            if self.prestage:
+                steps.append(f"download revision {self.revision}")
+            source = "the snap resource" if self.resource else "the store"
+            if self.prestage:
+                source = "the download"
+            steps.append(f"install revision {self.revision} from {source}")
+        if self.hold:
+            steps.append("hold")
+        return steps
+
+
+@dataclass(frozen=True)
+class AgentState:
+    """Parca Agent as observed on this machine, once per hook."""
+
+    installed: bool
+    revision: Optional[int] = None
+    version: Optional[str] = None
+    # whether the parca-agent-svc service is running
+    active: bool = False
+
+
+class FactCache:
+    """Facts about Parca Agent which rarely change, persisted across hooks.
+
+    Each fact expires after its own time to live, and is invalidated by the operations
+    which change it. Hits and misses are counted, to tell how often a hook is served
+    from the cache.
+    """
+
+    def __init__(self, facts: MutableMapping[str, Any]):
+        self._facts = facts
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, ttl: float, lookup: Callable[[], Any]) -> Any:
+        """Return a fact, looking it up (and caching it for `ttl` seconds) if needed."""
+        entry = self._facts.get(key)
+        if entry and entry["expires"] > time.time():
+            self.hits += 1
+            return entry["value"]
+        self.misses += 1
+        value = lookup()
+        self.put(key, value, ttl)
+        return value
+
+    def put(self, key: str, value: Any, ttl: float):
+        """Cache a fact for `ttl` seconds, e.g. when an operation just established it."""
+        now = time.time()
+        for expired in [k for k, entry in self._facts.items() if entry["expires"] <= now]:
+            del self._facts[expired]
+        self._facts[key] = {"value": value, "expires": now + ttl}
+
+    def forget(self, key: str):
+        """Invalidate a fact, e.g. to look it up afresh when checking it."""
+        self._facts.pop(key, None)
+
+    def clear(self):
+        """Invalidate all facts, e.g. after the snap was installed, refreshed or removed."""
+        self._facts.clear()
+
+
 class ParcaAgent:
     """Class representing Parca Agent on a host system."""
 
+    # only add a platform to charmcraft.yaml once the revision for its architecture is pinned
     _snap_revisions: Dict[Tuple[str, str], int] = {
         # (confinement, arch): revision
         ("classic", "amd64"): 2587,  # v0.35.3
     }
     _confinement = "classic"
+    # snap config keys managed from the remote store relation
+    _store_config_keys = (
+        "remote-store-address",
+        "remote-store-insecure",
+        "remote-store-bearer-token",
+    )
+    # how long each fact is cached for, in seconds, unless an operation invalidates it first
+    _fact_ttls = {
+        "held": 60 * 60,
+        # a snap revision always packages the same version: it's only looked up again once the
+        # snap is installed, refreshed or removed
+        "version": math.inf,
+    }
 
     def __init__(
-        self, app_name: str, store_config: Optional[Dict[str, str]], certificates: Set[str]
+        self,
+        app_name: str,
+        store_config: Optional[Dict[str, str]],
+        certificates: Union[Set[str], Callable[[], Set[str]]],
+        state: Optional[MutableMapping[str, Any]] = None,
+        snap_change_timeout: Optional[float] = None,
+        restart_debounce: float = 0,
     ):
+        """Parca Agent workload.
+
+        Args:
+            app_name: name of the charm application.
+            store_config: remote store configuration, if a store is related.
+            certificates: CA certificates to trust, or a callable returning them, only called
+                if (and once) they are needed.
+            state: mapping persisted across hooks, to keep track of the agent.
+            snap_change_timeout: maximum time, in seconds, to wait for snapd to install or
+                refresh the snap within a hook (or until done, if None).
+            restart_debounce: time window, in seconds, over which restarts are coalesced into
+                one, carried out by `restart_if_due` once the window closes.
+        """
         self._app_name = app_name
         self._store_config = store_config
-        self._certificates = certificates
+        self._certificates_source = certificates
+        self._state = state if state is not None else {}
+        self._facts = FactCache(self._state.setdefault("facts", {}))
+        self._snap_change_timeout = snap_change_timeout
+        self._restart_debounce = restart_debounce
+        self._change_progress = "waiting for snapd"
+        # hook-scoped snapshot of the snap, shared by every caller until a mutating operation
+        self._snap_snapshot: Optional[snap_client.Snap] = None
+        self._observed: Optional[AgentState] = None
+        self._snapd_calls_saved = 0
 
     # RECONCILERS
-    def reconcile(self):
-        """Parca agent reconcile logic."""
-        if self._store_config:
-            self._reconcile_certs()
-            self._reconcile_config()
-        else:
+    def reconcile(self, certificates: bool = True, store: bool = True) -> List[str]:
+        """Parca agent reconcile logic.
+
+        Whatever changed, Parca Agent is restarted at most once: a restart reloads all of its
+        eBPF programs, which is expensive on large hosts.
+
+        Args:
+            certificates: reconcile the CA certificates trusted by Parca Agent.
+            store: reconcile the snap config for the remote store.
+
+        Returns:
+            The inputs which changed, and were applied.
+        """
+        if not self._store_config:
             logger.error("no store configured: cannot reconcile parca_agent")
+            return []
+        plan = ReconcilePlan(
+            ca_bundle=self._plan_certs() if certificates else None,
+            config=self._plan_config() if store else {},
+        )
+        self._apply(plan)
+        return plan.reasons
+
+    @functools.cached_property
+    def _certificates(self) -> Set[str]:
+        """The CA certificates to trust, got at most once per hook."""
+        if callable(self._certificates_source):
+            return self._certificates_source()
+        return self._certificates_source
 
-    def _reconcile_certs(self):
-        """Configure certs, which are transferred from a certificate_transfer provider, on disk."""
-        changes = False
+    @property
+    def _ca_file_name(self) -> str:
         # TODO: is app_name enough to avoid collisions with other charms' certs?
-        combined_ca_path = CA_CERTS_PATH / f"receive-ca-cert-{self._app_name}-ca.crt"
-        if self._certificates:
-            combined_ca = "".join(cert + "\n\n" for cert in sorted(self._certificates))
-            current_combined_ca = combined_ca_path.read_text() if combined_ca_path.exists() else ""
-            if current_combined_ca != combined_ca:
-                logger.debug("Updating CA file with a new set of certificates.")
-                combined_ca_path.parent.mkdir(parents=True, exist_ok=True)
-                combined_ca_path.write_text(combined_ca)
-                self._update_ca_certs()
-                changes = True
-        else:
-            if combined_ca_path.exists():
-                logger.debug("Deleting CA file since no certificates were transferred.")
-                combined_ca_path.unlink()
-                self._update_ca_certs()
-                changes = True
-
-        if changes:
-            # parca-agent needs to stop and restart for it to notice the change in CAs
-            self._snap.stop()
-            self._snap.start()
-
-    def _reconcile_config(
-        self,
-    ):
-        """Configure Parca Agent on the host system.
+        return f"receive-ca-cert-{self._app_name}-ca.crt"
 
-        Restart Parca Agent snap if needed.
+    def _plan_certs(self) -> Optional[str]:
+        """Work out the CA file for certs transferred from a certificate_transfer provider.
+
+        Returns the new contents of the file, "" if it is to be removed, or None if unchanged.
+        """
+        combined_ca_path = CA_BUNDLE_DIR / self._ca_file_name
+        current_combined_ca = combined_ca_path.read_text() if combined_ca_path.exists() else None
+        combined_ca = "".join(cert + "\n\n" for cert in sorted(self._certificates))
+        unchanged = current_combined_ca == (combined_ca or None)
+        # the link drifts too: `update-ca-certificates --fresh` removes it, for one
+        if unchanged and self._ca_bundle_linked == bool(combined_ca):
+            # a CA installed system-wide by an earlier revision of this charm is still to go
+            if not (CA_CERTS_PATH / self._ca_file_name).exists():
+                return None
+        return combined_ca
+
+    @property
+    def _ca_bundle_linked(self) -> bool:
+        """Report if the system certs directory links to the CA bundle."""
+        link_path = SYSTEM_CERTS_DIR / self._ca_file_name
+        return link_path.is_symlink() and link_path.readlink() == CA_BUNDLE_DIR / link_path.name
+
+    def _plan_config(self) -> Dict[str, str]:
+        """Work out the snap config keys to change for the store config.
 
         Assumes it only will get called if _store_config is set (i.e. if a remote-store relation is active).
         """
         store_config = cast(Dict[str, str], self._store_config)
+        # fetch the whole snap config at once, rather than one `snap get` per key
+        current_config = self._snap.get_all()
         changes = {}
-        for key in ("remote-store-address", "remote-store-insecure", "remote-store-bearer-token"):
+        for key in self._store_config_keys:
             desired_value = store_config.get(key, "")
-            current_value = self._snap.get(key)
+            current_value = _config_value(current_config.get(key, ""))
             if current_value != desired_value:
                 changes[key] = desired_value
+        return changes
+
+    def _apply(self, plan: ReconcilePlan):
+        """Write the CA file and the snap config, then restart Parca Agent, as planned."""
+        reasons = plan.reasons
+        if not reasons:
+            return
+
+        if plan.ca_bundle is not None:
+            self._install_ca_bundle(plan.ca_bundle)
+
+        if plan.config:
+            self._snap.set(plan.config)
+
+        # parca-agent needs to restart for it to notice the change in CAs or config
+        self._request_restart(reasons)
+
+    def _request_restart(self, reasons: List[str]):
+        """Restart Parca Agent, or add to the pending restart if restarts are debounced."""
+        pending = self._state.get("pending-restart")
+        if pending:
+            reasons = sorted(set(pending["reasons"]) | set(reasons))
+        if not self._restart_debounce:
+            self._restart(reasons)
+            return
+
+        since = pending["since"] if pending else time.time()
+        self._state["pending-restart"] = {"since": since, "reasons": list(reasons)}
+        logger.info("restart of parca-agent pending: %s changed", ", ".join(reasons))
+
+    def restart_if_due(self, force: bool = False):
+        """Carry out the pending restart, if any, once the debounce window has closed.
+
+        Args:
+            force: restart, even if the debounce window is still open.
+        """
+        pending = self._state.get("pending-restart")
+        if not pending:
+            return
+        if force or time.time() - pending["since"] >= self._restart_debounce:
+            self._restart(pending["reasons"])
+
+    def _restart(self, reasons: List[str]):
+        logger.info("restarting parca-agent: %s changed", ", ".join(reasons))
+        self._snap.restart()
+        self._state.pop("pending-restart", None)
+        self._invalidate_snap()
+
+    @property
+    def restart_pending(self) -> bool:
+        """Report if a restart of Parca Agent has been debounced, and is yet to happen."""
+        return bool(self._state.get("pending-restart"))
+
+    def _install_ca_bundle(self, ca_bundle: str):
+        """Install the CA bundle trusted by parca-agent, or remove it if empty.
+
+        The bundle is linked from the system certs directory, where Go's certificate loader finds
+        it: every other Go program on the host (jujud, snapd, ...) trusts it as well. The system
+        bundle, and so OpenSSL-based programs, are left alone.
+        """
+        bundle_path = CA_BUNDLE_DIR / self._ca_file_name
+        link_path = SYSTEM_CERTS_DIR / self._ca_file_name
+        if ca_bundle:
+            bundle_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = bundle_path.with_name(bundle_path.name + ".tmp")
+            tmp_path.write_text(ca_bundle)
+            tmp_path.replace(bundle_path)
+            if not self._ca_bundle_linked:
+                # replace whatever is there under the link's name, e.g. a stale copy of a bundle
+                tmp_link_path = link_path.with_name(link_path.name + ".tmp")
+                tmp_link_path.unlink(missing_ok=True)
+                tmp_link_path.symlink_to(bundle_path)
+                tmp_link_path.replace(link_path)
+        else:
+            # no certificates were transferred (anymore)
+            bundle_path.unlink(missing_ok=True)
+            link_path.unlink(missing_ok=True)
 
-        # Restart the snap service
-        if changes:
-            self._snap.set(changes)
-            self._snap.restart()
+        legacy_path = CA_CERTS_PATH / self._ca_file_name
+        if legacy_path.exists():
+            # installed system-wide by an earlier revision of this charm: take it out
+            legacy_path.unlink()
+            self._update_ca_certs()
 
     def _update_ca_certs(self):
         try:
-            subprocess.run(["update-ca-certificates", "--fresh"])
+            subprocess.run(["update-ca-certificates"])
         except CalledProcessError as e:
             logger.warning(f"Failed to run update-ca-certificates: {e}")
 
-    def install(self):
-        """Install the Parca Agent snap package."""
+    def install(self, resource: Optional[Path] = None):
+        """Install the Parca Agent snap package.
+
+        If snapd takes longer than the snap change timeout, the install carries on in the
+        background and is followed up on by `track_change` in later hooks.
+
+        Args:
+            resource: a tarball holding the `.snap` and `.assert` files of the target revision,
+                to install it from instead of the store.
+        """
+        self._install("install", resource)
+
+    def refresh(self, resource: Optional[Path] = None):
+        """Refresh the Parca Agent snap if there is a new revision."""
+        # The operation here is exactly the same, so just call the install method
+        self._install("refresh", resource)
+
+    def _install(self, operation: str, resource: Optional[Path] = None):
         if not self.target_revision:
             raise SnapSpecError(
                 f"parca-agent snap is not supported for arch={ARCH} and confinement={self._confinement}."
             )
 
+        plan = self._plan_install(resource)
+        logger.info(
+            "parca-agent snap %s plan: %s", operation, ", ".join(plan.steps) or "nothing to do"
+        )
+        if not plan.prestage:
+            self._cancel_download()
         try:
-            self._snap.ensure(
-                state=snap.SnapState.Present, revision=self.target_revision, classic=True
-            )
+            if plan.revision is not None:
+                prestaged = plan.prestage and self._prestage(operation, plan.revision)
+                if prestaged is None:
+                    # still downloading: `track_change` refreshes once the download is done
+                    return
+                if plan.resource or prestaged:
+                    if not self._install_local(operation, plan.revision, plan.resource):
+                        return
+                elif not self._install_from_store(operation, plan.revision):
+                    return
+                _prune_snap_cache(keep=plan.revision)
+            if plan.hold:
+                self._hold()
+        finally:
+            if plan.steps:
+                self._invalidate_snap()
+
+    def _plan_install(self, resource: Optional[Path] = None) -> InstallPlan:
+        """Work out the snapd operations to get the target revision installed, and held.
+
+        Refreshing to the installed revision would still query the store: only install or
+        refresh if the revision or confinement differ, and only hold if not held already.
+        """
+        if (
+            self.installed
+            and self.revision == self.target_revision
+            and self._snap.confinement == self._confinement
+        ):
+            return InstallPlan(hold=not self.held)
+        # snapd keeps the hold of a snap it refreshes, but holding it again is cheap
+        return InstallPlan(
+            revision=self.target_revision,
+            resource=resource,
+            # download the new revision while the installed one keeps profiling
+            prestage=resource is None and self.installed,
+            hold=True,
+        )
+
+    def _install_from_store(self, operation: str, revision: int) -> bool:
+        """Install or refresh the snap from the store.
+
+        Returns whether snapd is done with it, rather than still at it in the background.
+        """
+        change_id = self._snap.ensure(
+            state=snap.SnapState.Present,
+            revision=revision,
+            classic=self._confinement == "classic",
+            wait=False,
+        )
+        # whatever snapd is doing to the snap, the facts cached about it no longer hold
+        self._facts.clear()
+        return self._wait_for_change(operation, change_id)
+
+    def _wait_for_change(self, operation: str, change_id: Optional[str]) -> bool:
+        """Wait for a snapd change installing or refreshing the snap, up to the timeout.
+
+        Returns whether snapd is done with it; if not, `track_change` follows up on it later.
+        """
+        if change_id:
+            change = self._snap.wait(change_id, self._snap_change_timeout)
+            if not change.ready:
+                logger.info("parca-agent snap %s still in progress: %s", operation, change_id)
+                self._state["pending-change"] = {"id": change_id, "operation": operation}
+                self._change_progress = change.progress
+                return False
+        return True
+
+    def _prestage(self, operation: str, revision: int) -> Optional[bool]:
+        """Download a revision of the snap ahead of refreshing to it.
+
+        However slow the store, the download isn't bounded by the snap change timeout: it is
+        started in the background by one hook, and picked up by a later one, once done.
+
+        Returns whether it was downloaded, or None while it still is being; if it could not be,
+        the snap is refreshed from the store as usual.
+        """
+        snap_file, assert_file = _staged_snap_files(revision)
+        if snap_file.exists() and assert_file.exists():
+            return True
+        pending = self._state.get("pending-download")
+        if pending and pending["revision"] != revision:
+            self._cancel_download()
+            pending = None
+        if not pending:
+            SNAP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            directory = tempfile.mkdtemp(dir=SNAP_CACHE_DIR, prefix="download-")
+            try:
+                process_group = _start_download(revision, Path(directory))
+            except snap.SnapError as e:
+                shutil.rmtree(directory, ignore_errors=True)
+                logger.warning("Failed to download parca-agent snap revision %d: %s", revision, e)
+                return False
+            logger.info("downloading parca-agent snap revision %d for its %s", revision, operation)
+            self._state["pending-download"] = {
+                "revision": revision,
+                "directory": directory,
+                "process-group": process_group,
+                "operation": operation,
+                "since": time.time(),
+            }
+            return None
+
+        status = _download_status(pending)
+        if status is None:
+            return None
+        return self._finish_download(status)
+
+    def _finish_download(self, status: str) -> bool:
+        """Stage the snap downloaded in the background, once its download is over.
+
+        Returns whether it was staged.
+        """
+        pending = self._state.pop("pending-download")
+        revision = pending["revision"]
+        try:
+            if status != "done":
+                raise snap.SnapError(status)
+            _keep_staged(revision, *_staged_snap_files(revision, Path(pending["directory"])))
         except snap.SnapError as e:
-            raise e
+            logger.warning("Failed to download parca-agent snap revision %d: %s", revision, e)
+            return False
+        finally:
+            _stop_download(pending)
+        return True
+
+    def _cancel_download(self):
+        """Stop downloading the snap in the background, if it is, e.g. as no longer needed."""
+        pending = self._state.pop("pending-download", None)
+        if pending:
+            _stop_download(pending)
+
+    @property
+    def download_in_progress(self) -> Optional[str]:
+        """Describe the download of the snap ahead of refreshing to it, if it is in progress."""
+        pending = self._state.get("pending-download")
+        if not pending:
+            return None
+        return f"downloading revision {pending['revision']} to refresh to"
+
+    def _install_local(
+        self, operation: str, revision: int, resource: Optional[Path] = None
+    ) -> bool:
+        """Install the snap from its `.snap` and `.assert` files, without going to the store.
+
+        If Parca Agent was running, the time snapd took to switch it over to the new revision is
+        reported. No profiles are sent during it; the profiling gap also spans the agent starting
+        up again and its first upload, so it is longer.
+
+        Returns whether snapd is done with it, rather than still at it in the background.
+
+        Raises:
+            SnapResourceError if the resource doesn't hold the given revision of the snap.
+        """
+        snap_file, assert_file = self._stage_snap(revision, resource)
+        try:
+            # acknowledge the assertions first: snapd then installs the snap as if from the store
+            _run_snap(["ack", str(assert_file)], self._snap_change_timeout)
+        except snap.SnapError as e:
+            raise SnapResourceError(f"Failed to acknowledge {assert_file}: {e}")
+        previous_revision = self.revision if self.running else None
+        started = time.monotonic()
+        # don't let the CLI wait for the change: wait for it like for any other, up to the timeout
+        command = ["install", "--no-wait", str(snap_file)]
+        if self._confinement == "classic":
+            command.append("--classic")
+        change_id = _run_snap(command, self._snap_change_timeout).strip()
+        self._facts.clear()
+        if not self._wait_for_change(operation, change_id):
+            return False
+        if previous_revision is not None:
+            duration = time.monotonic() - started
+            logger.info(
+                "parca-agent switched over from revision %s to %s: switch-over took %.1fs",
+                previous_revision,
+                revision,
+                duration,
+            )
+            self._state["last-switch-over"] = {
+                "from": previous_revision,
+                "to": revision,
+                "duration": duration,
+            }
+        return True
+
+    def _stage_snap(self, revision: int, resource: Optional[Path] = None) -> Tuple[Path, Path]:
+        """Get the `.snap` and `.assert` files of a revision of the snap ready to install.
+
+        They are unpacked from the snap resource if given, or else must have been downloaded by
+        `_prestage`. Snap revisions are immutable: once verified against its assertions, the
+        snap staged for a revision is kept, and reused by later installs on this machine, until
+        another revision is installed.
+
+        Raises:
+            SnapError if the snap isn't staged, or SnapResourceError if it could not be unpacked.
+        """
+        snap_file, assert_file = _staged_snap_files(revision)
+        if snap_file.exists() and assert_file.exists():
+            return snap_file, assert_file
+        if not resource:
+            raise snap.SnapError(f"parca-agent snap revision {revision} was not downloaded")
+
+        SNAP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=SNAP_CACHE_DIR) as staging:
+            _keep_staged(revision, *_unpack_snap_resource(resource, Path(staging)))
+        return snap_file, assert_file
+
+    @property
+    def last_switch_over(self) -> Optional[Dict[str, Any]]:
+        """The last switch-over to a pre-staged revision: from and to which, and how long it took."""
+        return self._state.get("last-switch-over")
+
+    def track_change(self):
+        """Follow up on a snap install or refresh left in progress by an earlier hook.
+
+        Once snapd is done with it, the snap is held, as `install` would have done. Once a
+        revision downloaded ahead of a refresh is, the snap is refreshed to it.
+
+        Raises:
+            SnapError if the install or refresh failed.
+        """
+        pending = self._state.get("pending-change")
+        if not pending:
+            download = self._state.get("pending-download")
+            if download and _download_status(download) is not None:
+                # the download of the revision to refresh to is over: refresh, one way or another
+                self._install(download["operation"])
+            return
+
+        change = snap_client.get_change(pending["id"])
+        if not change.ready:
+            self._change_progress = change.progress
+            return
+
+        self._state.pop("pending-change")
+        if change.failed:
+            raise snap.SnapError(f"parca-agent snap {pending['operation']} failed: {change.err}")
+        logger.info("parca-agent snap %s completed", pending["operation"])
+        self._facts.clear()
+        self._hold()
+        self._invalidate_snap()
+
+    def probe(self, timeout: float = 1.0) -> bool:
+        """Cheaply check that Parca Agent is healthy: running, and serving its metrics.
+
+        Whether its service is running is known from the snap, observed once per hook: only
+        the response status of the metrics endpoint is waited for, not the metrics themselves.
+        """
+        if not self.observed_state.active:
+            return False
+        # parca-agent listens locally: don't go through any proxy configured for the machine
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+        try:
+            with opener.open(METRICS_URL, timeout=timeout) as response:
+                return response.status == 200
+        except OSError as e:
+            logger.warning("parca-agent metrics endpoint not responding: %s", e)
+            return False
+
+    def ensure_held(self):
+        """Hold the snap if snapd reports it isn't, whatever the fact cache says."""
+        self._facts.forget("held")
+        if self.installed and not self.held:
+            logger.warning("parca-agent snap isn't held anymore: holding it again")
+            self._hold()
+            self._invalidate_snap()
+
+    def _hold(self):
+        """Hold the snap, so that it is only ever refreshed by the charm."""
         self._snap.hold()
+        self._facts.put("held", True, self._fact_ttls["held"])
 
-    def refresh(self):
-        """Refresh the Parca Agent snap if there is a new revision."""
-        # The operation here is exactly the same, so just call the install method
-        self.install()
+    @property
+    def change_in_progress(self) -> Optional[str]:
+        """Describe the snap install or refresh still in progress, if any."""
+        pending = self._state.get("pending-change")
+        if not pending:
+            return None
+        return f"{pending['operation']} in progress: {self._change_progress}"
 
     def start(self):
-        """Start and enable Parca Agent using the snap service."""
+        """Start and enable Parca Agent using the snap service, unless it already is."""
+        service = self._snap.known_services.get("parca-agent-svc", {})
+        if service.get("active") and service.get("enabled"):
+            return
         self._snap.start(enable=True)
+        self._invalidate_snap()
 
     def stop(self):
         """Stop Parca Agent using the snap service."""
         self._snap.stop(disable=True)
+        self._invalidate_snap()
 
     def remove(self):
         """Remove the Parca Agent snap, preserving config and data."""
         self._snap.ensure(snap.SnapState.Absent)
+        self._invalidate_snap()
+        self._facts.clear()
+        # don't leave a dangling link in the system certs directory behind
+        (SYSTEM_CERTS_DIR / self._ca_file_name).unlink(missing_ok=True)
+        # keep the snap staged for the target revision: a unit added back to this machine
+        # installs it again without copying it
+        self._cancel_download()
+        _prune_snap_cache(keep=self.target_revision)
 
     @property
     def target_revision(self) -> Optional[int]:
@@ -167,24 +746,82 @@ class ParcaAgent:
         """Report if the 'parca-agent-svc' snap service is running."""
         if self.installed:
             try:
-                return self._snap.services["parca-agent-svc"]["active"]
+                # reported by snapd along with the snap: no need to query its apps again
+                return self._snap.known_services["parca-agent-svc"]["active"]
             except KeyError as e:
                 logger.exception("Failed to get parca-agent snap state %s", str(e))
         return False
 
+    @property
+    def observed_state(self) -> AgentState:
+        """Parca Agent as observed on this machine.
+
+        It is observed from a single snapd request, shared with every other lookup of the snap
+        in this hook, and only observed again once an operation changes the snap.
+        """
+        if self._observed is None:
+            if not self.installed:
+                self._observed = AgentState(installed=False)
+            else:
+                self._observed = AgentState(
+                    installed=True,
+                    revision=self.revision,
+                    version=self.version,
+                    active=self.running,
+                )
+        return self._observed
+
     @property
     def version(self) -> str:
-        """Report the version of Parca Agent currently installed."""
-        if self.installed:
-            results = check_output(["parca-agent", "--version"]).decode()
-            return parse_version(results)
-        raise snap.SnapError("parca agent snap not installed, cannot fetch version")
+        """Report the version of Parca Agent currently installed.
+
+        It is obtained from `parca-agent --version`, and cached per snap revision, across hooks.
+        """
+        if not self.installed:
+            raise snap.SnapError("parca agent snap not installed, cannot fetch version")
+
+        return self._facts.get(
+            f"version/{self.revision}", self._fact_ttls["version"], self._lookup_version
+        )
+
+    def _lookup_version(self) -> str:
+        results = check_output(["parca-agent", "--version"]).decode()
+        return parse_version(results)
+
+    @property
+    def held(self) -> bool:
+        """Report if the Parca Agent snap is held, i.e. not refreshed automatically."""
+        return self.installed and self._facts.get(
+            "held", self._fact_ttls["held"], lambda: self._snap.held
+        )
+
+    @property
+    def fact_cache_stats(self) -> Dict[str, int]:
+        """Number of facts served from the cross-hook fact cache, and looked up afresh."""
+        return {"hits": self._facts.hits, "misses": self._facts.misses}
+
+    @property
+    def snapd_calls_saved(self) -> int:
+        """Number of snapd lookups served from the hook-scoped snap snapshot."""
+        return self._snapd_calls_saved
 
     @property
-    def _snap(self):
-        """Return a representation of the Parca Agent snap."""
-        cache = snap.SnapCache()
-        return cache["parca-agent"]
+    def _snap(self) -> snap_client.Snap:
+        """Return a representation of the Parca Agent snap.
+
+        The snap state is looked up once and shared by every caller, until an operation
+        that mutates the snap invalidates it.
+        """
+        if self._snap_snapshot is None:
+            self._snap_snapshot = snap_client.get_snap("parca-agent")
+        else:
+            self._snapd_calls_saved += 1
+        return self._snap_snapshot
+
+    def _invalidate_snap(self):
+        """Drop the snap snapshot so that the next access reads the state from snapd again."""
+        self._snap_snapshot = None
+        self._observed = None
 
     @property
     def revision(self):
@@ -192,6 +829,171 @@ class ParcaAgent:
         return self._snap.revision
 
 
+def _unpack_snap_resource(resource: Path, directory: Path) -> Tuple[Path, Path]:
+    """Unpack the `.snap` and `.assert` files of a snap resource into a directory.
+
+    Raises:
+        SnapResourceError if the resource isn't a tarball holding both.
+    """
+    unpacked = {}
+    try:
+        with tarfile.open(resource) as tar:
+            for member in tar.getmembers():
+                suffix = Path(member.name).suffix
+                if member.isfile() and suffix in (".snap", ".assert"):
+                    target = directory / f"parca-agent{suffix}"
+                    with tar.extractfile(member) as source, target.open("wb") as file:  # type: ignore
+                        shutil.copyfileobj(source, file, 1 << 20)
+                    unpacked[suffix] = target
+    except tarfile.TarError as e:
+        raise SnapResourceError(f"Failed to unpack the snap resource: {e}")
+    if unpacked.keys() != {".snap", ".assert"}:
+        raise SnapResourceError("The snap resource must hold a .snap and an .assert file")
+    return unpacked[".snap"], unpacked[".assert"]
+
+
+def _run_snap(args: List[str], timeout: Optional[float]) -> str:
+    """Run a `snap` command, and return its output.
+
+    Raises:
+        SnapError if it failed, or did not complete within the timeout (in seconds).
+    """
+    try:
+        return subprocess.run(
+            ["snap", *args], check=True, capture_output=True, text=True, timeout=timeout
+        ).stdout
+    except CalledProcessError as e:
+        raise snap.SnapError(f"snap {args[0]} failed: {e.stderr}")
+    except subprocess.TimeoutExpired:
+        raise snap.SnapError(f"snap {args[0]} did not complete within {timeout}s")
+    except OSError as e:
+        raise snap.SnapError(f"snap {args[0]} failed: {e}")
+
+
+def _staged_snap_files(revision: int, directory: Optional[Path] = None) -> Tuple[Path, Path]:
+    """Return the `.snap` file of a revision of the snap, and its assertions, in a directory."""
+    snap_file = (directory or SNAP_CACHE_DIR) / f"parca-agent_{revision}.snap"
+    return snap_file, snap_file.with_suffix(".assert")
+
+
+def _keep_staged(revision: int, staged_snap: Path, staged_assert: Path):
+    """Verify a revision of the snap, and keep it in the snap cache.
+
+    Raises:
+        SnapResourceError if it isn't the given revision of the snap.
+    """
+    _verify_snap(staged_snap, staged_assert, revision)
+    snap_file, assert_file = _staged_snap_files(revision)
+    staged_assert.replace(assert_file)
+    staged_snap.replace(snap_file)
+
+
+# `snap download` in its own process group, outliving the hook: it records its exit status and
+# output in the directory it downloads to, for a later hook to pick up
+_DOWNLOAD_SCRIPT = (
+    '(snap download parca-agent --revision="$1" --target-directory="$2" >"$2/log" 2>&1;'
+    ' echo $? >"$2/status.tmp"; mv "$2/status.tmp" "$2/status") &'
+)
+
+
+def _start_download(revision: int, directory: Path) -> int:
+    """Start downloading a revision of the snap, and its assertions, into a directory.
+
+    Returns:
+        The id of the process group of the download.
+
+    Raises:
+        SnapError if it could not be started.
+    """
+    try:
+        process = subprocess.Popen(
+            ["sh", "-c", _DOWNLOAD_SCRIPT, "sh", str(revision), str(directory)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        raise snap.SnapError(f"snap download failed to start: {e}")
+    if process.wait():
+        raise snap.SnapError(f"snap download failed to start: exit status {process.returncode}")
+    # the shell leading the new session exits once the download is in the background, but its
+    # process group lives on with the download
+    return process.pid
+
+
+def _download_status(pending: Dict[str, Any]) -> Optional[str]:
+    """How a download started by `_start_download` went: "done", why it failed, or None yet."""
+    directory = Path(pending["directory"])
+    try:
+        status = (directory / "status").read_text().strip()
+    except FileNotFoundError:
+        if time.time() - pending["since"] < DOWNLOAD_TIMEOUT:
+            return None
+        return f"snap download not done after {DOWNLOAD_TIMEOUT}s"
+    if status == "0":
+        return "done"
+    log = (directory / "log").read_text(errors="replace").strip()
+    return f"snap download failed: {log}"
+
+
+def _stop_download(pending: Dict[str, Any]):
+    """Kill a download started by `_start_download` if still running, and remove its files."""
+    directory = Path(pending["directory"])
+    if not (directory / "status").exists():
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(pending["process-group"], signal.SIGTERM)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def _prune_snap_cache(keep: Optional[int]):
+    """Remove the snaps staged for any revision but the given one, e.g. the installed one."""
+    for path in SNAP_CACHE_DIR.glob("parca-agent_*"):
+        if path.stem != f"parca-agent_{keep}":
+            path.unlink()
+
+
+def _verify_snap(snap_file: Path, assert_file: Path, revision: int):
+    """Check that a `.snap` file is the given revision of the snap, as asserted by snapd.
+
+    Its assertions are only trusted once acknowledged by snapd, which checks their signatures:
+    this merely fails early if the resource holds the wrong snap.
+
+    Raises:
+        SnapResourceError if it isn't.
+    """
+    headers = _assertion_headers(assert_file.read_text(), "snap-revision")
+    if headers.get("snap-revision") != str(revision):
+        raise SnapResourceError(
+            f"The snap resource holds revision {headers.get('snap-revision')}, not {revision}"
+        )
+    digest = hashlib.sha3_384()
+    with snap_file.open("rb") as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    # snapd encodes digests in unpadded, URL-safe base64
+    if base64.urlsafe_b64encode(digest.digest()).decode().rstrip("=") != headers.get(
+        "snap-sha3-384"
+    ):
+        raise SnapResourceError("The snap in the resource doesn't match its assertions")
+
+
+def _assertion_headers(assertions: str, assertion_type: str) -> Dict[str, str]:
+    """Return the headers of the first assertion of a type, in a `.assert` file."""
+    for block in assertions.split("\n\n"):
+        headers = dict(
+            line.split(": ", 1) for line in block.splitlines() if ": " in line and line[0] != " "
+        )
+        if headers.get("type") == assertion_type:
+            return headers
+    return {}
+
+
+def _config_value(value: Any) -> str:
+    """Render a snap config value the way `snap get <key>` would print it."""
+    return value if isinstance(value, str) else json.dumps(value)
+
+
 def parse_version(vstr: str) -> str:
     """Parse the output of 'parca --version' and return a representative string."""
     parts = vstr.split(" ")
@@ -0,0 +1,467 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Talk to snapd through its REST API, to look up and operate a single snap.
+
+The snap charm lib lists every installed snap to look one up, and shells out to the `snap`
+command to change it. Here, a snap is looked up by name, and changed through the snapd API,
+over a keep-alive connection shared by every client of the process. Errors are reported with
+the exceptions of the snap charm lib.
+"""
+
+import http.client
+import json
+import os
+import select
+import socket
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+from charms.operator_libs_linux.v1.snap import SnapAPIError, SnapError, SnapState
+
+# where snapd and its CLI are to be found
+SNAPD_SOCKET = "/run/snapd.socket"
+SNAP_CLI = "/usr/bin/snap"
+
+# interval, in seconds, between two polls of a snapd change
+CHANGE_POLL_INTERVAL = 0.1
+
+# upper bounds, in seconds, of the snapd request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf"))
+
+
+class SnapChange:
+    """A snapd change, e.g. installing a snap, as reported by snapd."""
+
+    def __init__(
+        self,
+        id: str,
+        kind: str = "",
+        summary: str = "",
+        status: str = "",
+        ready: bool = False,
+        err: Optional[str] = None,
+        tasks: Optional[List[Dict]] = None,
+        **kwargs,
+    ):
+        self.id = id
+        self.kind = kind
+        self.summary = summary
+        self.status = status
+        self.ready = ready
+        self.err = err
+        self.tasks = tasks or []
+
+    @property
+    def failed(self) -> bool:
+        """Report whether the change is ready, but did not complete successfully."""
+        return self.ready and self.status != "Done"
+
+    @property
+    def progress(self) -> str:
+        """Describe how far along the change is, e.g. "Download snap (42%)"."""
+        for task in self.tasks:
+            if task.get("status") != "Doing":
+                continue
+            progress = task.get("progress", {})
+            total = progress.get("total", 0)
+            if total > 1:
+                return f"{task['summary']} ({100 * progress['done'] // total}%)"
+            return task["summary"]
+
+        done = sum(1 for task in self.tasks if task.get("status") == "Done")
+        return f"{done}/{len(self.tasks)} tasks done"
+
+
+class _UnixSocketConnection(http.client.HTTPConnection):
+    """HTTP connection to a unix socket."""
+
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        """Connect to the unix socket, rather than a TCP one."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class _ConnectionPool:
+    """Keep-alive HTTP connection to a snapd socket, shared by all clients of a process.
+
+    snapd speaks HTTP/1.1, so one connection serves any number of requests, as long as they are
+    sent one at a time and each response is read in full before the next request goes out. An
+    idle connection which snapd dropped is replaced before sending a request over it. Should it
+    drop the connection as the request goes out anyway, only a GET request is retried, on a
+    fresh connection: snapd may have received another request already, and acted on it.
+
+    The pool also keeps count of the requests made to snapd, and of their latency.
+    """
+
+    _pools: Dict[str, "_ConnectionPool"] = {}
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.request_count = 0
+        self.latency_histogram = dict.fromkeys(LATENCY_BUCKETS, 0)
+        self._connection: Optional[_UnixSocketConnection] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, socket_path: str) -> "_ConnectionPool":
+        """Return the pool for a socket path, creating it on first use."""
+        if socket_path not in cls._pools:
+            cls._pools[socket_path] = cls(socket_path)
+        return cls._pools[socket_path]
+
+    def request(
+        self, method: str, url: str, body: Optional[bytes], headers: Dict, timeout: float
+    ) -> Tuple[http.client.HTTPResponse, bytes]:
+        """Send a request over the shared connection; return the response and its body."""
+        start = time.monotonic()
+        try:
+            with self._lock:
+                reused = self._connection is not None
+                try:
+                    return self._send(method, url, body, headers, timeout)
+                except ConnectionError:
+                    if not reused or method != "GET":
+                        raise
+                # snapd closed the idle connection we were holding on to: retry on a new one
+                return self._send(method, url, body, headers, timeout)
+        finally:
+            self._record(time.monotonic() - start)
+
+    def _record(self, latency: float):
+        self.request_count += 1
+        for bucket in LATENCY_BUCKETS:
+            if latency <= bucket:
+                self.latency_histogram[bucket] += 1
+                break
+
+    def _send(
+        self, method: str, url: str, body: Optional[bytes], headers: Dict, timeout: float
+    ) -> Tuple[http.client.HTTPResponse, bytes]:
+        connection, self._connection = self._connection, None
+        if connection is not None and _closed_by_peer(connection):
+            connection.close()
+            connection = None
+        if connection is None:
+            connection = _UnixSocketConnection(self.socket_path, timeout)
+        else:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+
+        try:
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._connection = connection
+        return response, data
+
+
+def _closed_by_peer(connection: http.client.HTTPConnection) -> bool:
+    """Report whether an idle connection was closed by its peer, i.e. reads as end of file."""
+    if connection.sock is None:
+        return False
+    readable, _, _ = select.select([connection.sock], [], [], 0)
+    return bool(readable)
+
+
+class SnapClient:
+    """Client for the parts of the snapd REST API the charm uses."""
+
+    def __init__(self, socket_path: Optional[str] = None, timeout: float = 5.0):
+        """Snapd API client.
+
+        Args:
+            socket_path: path to the snapd socket, SNAPD_SOCKET by default.
+            timeout: timeout of each request, in seconds.
+        """
+        self._pool = _ConnectionPool.get(socket_path or SNAPD_SOCKET)
+        self.timeout = timeout
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """Report the number of requests made to this client's snapd socket, and their latency.
+
+        The latency histogram maps the upper bound of each bucket, in seconds, to a count.
+        """
+        return {
+            "requests": self._pool.request_count,
+            "latency": dict(self._pool.latency_histogram),
+        }
+
+    def _request(
+        self, method: str, path: str, query: Optional[Dict] = None, body: Optional[Dict] = None
+    ) -> Dict[str, Any]:
+        """Make a JSON request to snapd; return the whole response document.
+
+        Raises:
+            SnapAPIError if snapd could not be reached, or answered with an error.
+        """
+        url = f"/v2/{path}"
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        headers = {"Accept": "application/json"}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+
+        try:
+            response, raw = self._pool.request(method, url, data, headers, self.timeout)
+        except OSError as e:
+            raise SnapAPIError({}, 500, "Not found", str(e))
+
+        try:
+            document = json.loads(raw.decode())
+        except ValueError as e:
+            raise SnapAPIError({}, response.status, response.reason, f"{type(e).__name__} - {e}")
+        if response.status >= 400:
+            result = document.get("result", {})
+            raise SnapAPIError(result, response.status, response.reason, result.get("message", ""))
+        return document
+
+    def get_installed_snap(self, name: str) -> Dict:
+        """Get information about a single, currently installed snap."""
+        return self._request("GET", f"snaps/{name}")["result"]
+
+    def get_snap_conf(self, name: str) -> Dict:
+        """Get the whole configuration of a named, currently installed snap."""
+        return self._request("GET", f"snaps/{name}/conf")["result"]
+
+    def get_change(self, change_id: str) -> Dict:
+        """Get the status of a snapd change."""
+        return self._request("GET", f"changes/{change_id}")["result"]
+
+    def post_snap(self, name: str, action: str, options: Optional[Dict] = None) -> str:
+        """Start a snapd change acting on a snap (e.g. install, refresh, hold); return its ID."""
+        body = {"action": action, **(options or {})}
+        return self._request("POST", f"snaps/{name}", body=body)["change"]
+
+    def post_apps(self, action: str, names: List[str], options: Optional[Dict] = None) -> str:
+        """Start a snapd change acting on snap services (start, stop, restart); return its ID."""
+        body = {"action": action, "names": names, **(options or {})}
+        return self._request("POST", "apps", body=body)["change"]
+
+    def put_snap_conf(self, name: str, config: Dict) -> str:
+        """Start a snapd change setting the configuration of a snap; return its ID."""
+        return self._request("PUT", f"snaps/{name}/conf", body=config)["change"]
+
+
+class Snap:
+    """A snap, as reported by snapd when it was looked up, operated through the snapd API.
+
+    Operations which change the snap wait for the resulting snapd change to complete, and
+    return its ID. `ensure` can also return as soon as the change is submitted, leaving the
+    caller to track it with `wait`.
+    """
+
+    def __init__(self, name: str, info: Optional[Dict] = None):
+        """Snap looked up from snapd.
+
+        Args:
+            name: name of the snap.
+            info: the description of the snap by snapd, or None if it isn't installed.
+        """
+        self._name = name
+        self._info = info or {}
+        self._present = info is not None
+        self._hold = self._info.get("hold")
+        self._client = SnapClient()
+
+    @property
+    def name(self) -> str:
+        """The name of the snap."""
+        return self._name
+
+    @property
+    def present(self) -> bool:
+        """Report whether the snap is installed."""
+        return self._present
+
+    @property
+    def revision(self) -> int:
+        """The installed revision of the snap, or 0 if not installed."""
+        return int(self._info.get("revision", 0))
+
+    @property
+    def confinement(self) -> str:
+        """The confinement of the installed snap: "classic" or "strict"."""
+        return self._info.get("confinement", "")
+
+    @property
+    def held(self) -> bool:
+        """Report whether the snap has a refresh hold."""
+        return bool(self._hold)
+
+    @property
+    def known_services(self) -> Dict[str, Dict[str, Any]]:
+        """The services of the snap, as reported along with it by snapd, by name."""
+        return {
+            app["name"]: {
+                "daemon": app["daemon"],
+                "enabled": app.get("enabled", False),
+                "active": app.get("active", False),
+            }
+            for app in self._info.get("apps", [])
+            if "daemon" in app
+        }
+
+    def ensure(
+        self,
+        state: SnapState,
+        classic: bool = False,
+        revision: Optional[int] = None,
+        wait: bool = True,
+    ) -> Optional[str]:
+        """Install (or refresh) the snap, or remove it.
+
+        Args:
+            state: `SnapState.Present` to install or refresh the snap, or `SnapState.Absent`
+                to remove it.
+            classic: whether to install, or refresh, it with classic confinement.
+            revision: the revision to install or refresh to.
+            wait: whether to wait for the snapd change to complete; if not, track it with `wait`.
+
+        Returns:
+            the ID of the snapd change, or None if there was nothing to do.
+
+        Raises:
+            SnapError if snapd failed to do it.
+        """
+        if state is SnapState.Absent:
+            return self._post("remove", wait=wait) if self._present else None
+
+        # snapd keeps the classic confinement of a snap it refreshes, but a strictly confined
+        # snap needs the consent to be refreshed to a classic revision, as on install
+        options: Dict[str, Any] = {"classic": classic}
+        if revision:
+            options["revision"] = str(revision)
+        return self._post("refresh" if self._present else "install", options, wait)
+
+    def wait(self, change_id: str, timeout: Optional[float] = None) -> SnapChange:
+        """Wait for a snapd change acting on this snap to be ready.
+
+        Args:
+            change_id: the ID of the snapd change.
+            timeout: maximum time to wait, in seconds, otherwise wait until the change is ready.
+                With a timeout of 0, the change is only checked once.
+
+        Returns:
+            the last observed state of the change, which is not ready if the timeout expired.
+
+        Raises:
+            SnapError if the change could not be tracked or did not complete successfully.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            change = get_change(change_id)
+            if change.ready or (deadline is not None and time.monotonic() >= deadline):
+                break
+            time.sleep(CHANGE_POLL_INTERVAL)
+
+        if change.failed:
+            raise SnapError(
+                f"Snap: {self._name!r}; change {change_id} ({change.summary!r}) failed: {change.err}"
+            )
+        return change
+
+    def get_all(self) -> Dict[str, Any]:
+        """Fetch the whole snap configuration document in a single snapd request."""
+        try:
+            return self._client.get_snap_conf(self._name)
+        except SnapAPIError as e:
+            raise SnapError(f"Snap: {self._name!r}; failed to get configuration: {e.message}")
+
+    def set(self, config: Dict[str, Any]) -> str:
+        """Set snap configuration values, where None unsets a key."""
+        try:
+            change_id = self._client.put_snap_conf(self._name, config)
+        except SnapAPIError as e:
+            raise SnapError(f"Snap: {self._name!r}; failed to set configuration: {e.message}")
+        self.wait(change_id)
+        return change_id
+
+    def start(self, enable: bool = False) -> str:
+        """Start the services of the snap, and enable them if asked to."""
+        return self._post_apps("start", {"enable": enable})
+
+    def stop(self, disable: bool = False) -> str:
+        """Stop the services of the snap, and disable them if asked to."""
+        return self._post_apps("stop", {"disable": disable})
+
+    def restart(self) -> str:
+        """Restart the services of the snap."""
+        return self._post_apps("restart", {"reload": False})
+
+    def hold(self) -> str:
+        """Hold refreshes of the snap indefinitely."""
+        change_id = self._post("hold", {"time": "forever", "hold-level": "general"})
+        self._hold = "forever"
+        return change_id
+
+    def _post(self, action: str, options: Optional[Dict] = None, wait: bool = True) -> str:
+        try:
+            change_id = self._client.post_snap(self._name, action, options)
+        except SnapAPIError as e:
+            raise SnapError(f"Snap: {self._name!r}; action {action!r} failed: {e.message}")
+        if wait:
+            self.wait(change_id)
+        return change_id
+
+    def _post_apps(self, action: str, options: Dict) -> str:
+        try:
+            change_id = self._client.post_apps(action, [self._name], options)
+        except SnapAPIError as e:
+            raise SnapError(f"Could not {action} services of snap [{self._name}]: {e.message}")
+        self.wait(change_id)
+        return change_id
+
+
+def _snapd_installed() -> bool:
+    return os.path.isfile(SNAP_CLI)
+
+
+def get_snap(name: str) -> Snap:
+    """Look up a single snap by name, without listing every installed snap.
+
+    A snap which isn't installed is returned as absent, rather than looked up in the store,
+    which machines may not have access to.
+
+    Raises:
+        SnapError if snapd is not installed or cannot be queried.
+    """
+    if not _snapd_installed():
+        raise SnapError("snapd is not installed or not in /usr/bin")
+
+    try:
+        return Snap(name, SnapClient().get_installed_snap(name))
+    except SnapAPIError as e:
+        if e.code != 404:
+            raise SnapError(f"Failed to query snapd for snap {name}: {e.message}")
+    return Snap(name)
+
+
+def get_change(change_id: str) -> SnapChange:
+    """Get the current state of a snapd change, e.g. one started in an earlier hook.
+
+    Raises:
+        SnapError if the change could not be retrieved.
+    """
+    try:
+        return SnapChange(**SnapClient().get_change(change_id))
+    except SnapAPIError as e:
+        raise SnapError(f"Could not get snapd change {change_id}: {e.message}")
@@ -0,0 +1,7 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+import sys
+from pathlib import Path
+
+# the benchmarks run against the fake snapd the unit tests use
+sys.path.insert(0, str(Path(__file__).parents[1] / "unit"))
@@ -0,0 +1,78 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Benchmark the processing of each charm event, against a fake snapd and a temporary filesystem.
+#
+# For each event, report the p50/p95 wall time over BENCHMARK_ROUNDS runs, then the peak memory
+# allocated, the number of subprocesses spawned, hook tools invoked and snapd requests made, and
+# how many snapd lookups the snap snapshot and the fact cache saved, while processing it once. The results are written, as JSON, to BENCHMARK_OUTPUT.
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+from call_counter import count_spawns
+from hook_scenarios import SCENARIOS, machine
+from ops.testing import Context, State
+
+from charm import ParcaAgentOperatorCharm
+
+ROUNDS = int(os.getenv("BENCHMARK_ROUNDS", "20"))
+OUTPUT = Path(os.getenv("BENCHMARK_OUTPUT", "benchmark-hooks.json"))
+
+_results = {}
+
+
+@pytest.fixture(scope="session", autouse=True)
+def results():
+    yield _results
+    OUTPUT.write_text(json.dumps({"rounds": ROUNDS, "events": _results}, indent=2) + "\n")
+
+
+def _percentile(samples, percent):
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+@pytest.mark.parametrize("event_name", SCENARIOS)
+def test_hook(tmp_path, event_name):
+    scenario = SCENARIOS[event_name]
+    context = Context(ParcaAgentOperatorCharm)
+    with machine(tmp_path) as m:
+        state = State(leader=True, relations=scenario.relations, resources=m.resources)
+        if scenario.settled:
+            scenario.setup(m)
+            state = context.run(scenario.event(context.on), state)
+
+        wall_times = []
+        for _ in range(ROUNDS):
+            scenario.setup(m)
+            start = time.perf_counter()
+            context.run(scenario.event(context.on), state)
+            wall_times.append(time.perf_counter() - start)
+
+        scenario.setup(m)
+        snapd_calls = len(m.snapd.requests)
+        tracemalloc.start()
+        with count_spawns() as spawns, context(scenario.event(context.on), state) as manager:
+            state_out = manager.run()
+            parca_agent = manager.charm.parca_agent
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapd_calls = len(m.snapd.requests) - snapd_calls
+
+    assert state_out.unit_status.name != "error"
+    _results[event_name] = {
+        "wall_time": {
+            "p50": _percentile(wall_times, 50),
+            "p95": _percentile(wall_times, 95),
+        },
+        "peak_memory_bytes": peak_memory,
+        "subprocess_calls": spawns.subprocesses,
+        "hook_tool_calls": spawns.hook_tools,
+        "snapd_calls": snapd_calls,
+        "snapd_calls_saved": parca_agent.snapd_calls_saved,
+        "fact_cache": parca_agent.fact_cache_stats,
+    }
@@ -0,0 +1,19 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Wall-clock budgets depend on the machine they run on: they're checked here rather than in the
+# unit tests, and against the fastest of a few imports, to leave out noise from the host.
+from import_timer import import_times
+
+ROUNDS = 5
+# Budget for importing the charm on top of ops, which we can't do anything about (in seconds).
+IMPORT_BUDGET = 0.15
+UNAVOIDABLE = ("ops",)
+
+
+def test_import_time_budget():
+    costs = []
+    for _ in range(ROUNDS):
+        times = import_times()
+        costs.append(times["charm"] - sum(times[module] for module in UNAVOIDABLE))
+    assert min(costs) < IMPORT_BUDGET
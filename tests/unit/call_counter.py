@@ -0,0 +1,105 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Count the processes a charm would spawn while handling an event.
+
+Processes are spawned by the charm itself, through `subprocess`, and by ops, which invokes a
+Juju hook tool for each call to its model backend.
+"""
+
+import os
+import sys
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from typing import Iterator, List
+from unittest.mock import patch
+
+from scenario.mocking import _MockModelBackend
+
+# the model backend methods which, in a real unit, each invoke a hook tool
+HOOK_TOOLS = (
+    "action_fail",
+    "action_get",
+    "action_log",
+    "action_set",
+    "application_version_set",
+    "close_port",
+    "config_get",
+    "credential_get",
+    "is_leader",
+    "juju_log",
+    "network_get",
+    "open_port",
+    "opened_ports",
+    "planned_units",
+    "relation_get",
+    "relation_ids",
+    "relation_list",
+    "relation_model_get",
+    "relation_remote_app_name",
+    "relation_set",
+    "resource_get",
+    "secret_add",
+    "secret_get",
+    "secret_grant",
+    "secret_info_get",
+    "secret_remove",
+    "secret_revoke",
+    "secret_set",
+    "status_get",
+    "status_set",
+    "storage_add",
+    "storage_get",
+    "storage_list",
+)
+
+_active: List[Counter] = []
+
+
+def _audit(event: str, args: tuple):
+    if event == "subprocess.Popen":
+        for counter in _active:
+            counter[f"subprocess:{os.path.basename(args[0])}"] += 1
+
+
+# audit hooks can't be removed: install ours once, and only count while a context is active
+sys.addaudithook(_audit)
+
+
+def _counting(counter: Counter, name: str, method):
+    key = f"hook-tool:{name.replace('_', '-')}"
+
+    def wrapper(*args, **kwargs):
+        # ops caches leadership for 30s, unlike the mock backend: it only asks once per event
+        if not (name == "is_leader" and counter[key]):
+            counter[key] += 1
+        return method(*args, **kwargs)
+
+    return wrapper
+
+
+class Spawns(Counter):
+    """The number of processes spawned, by "subprocess:<executable>" or "hook-tool:<name>"."""
+
+    @property
+    def subprocesses(self) -> int:
+        """Count the processes spawned through `subprocess`."""
+        return sum(n for key, n in self.items() if key.startswith("subprocess:"))
+
+    @property
+    def hook_tools(self) -> int:
+        """Count the hook tools invoked."""
+        return sum(n for key, n in self.items() if key.startswith("hook-tool:"))
+
+
+@contextmanager
+def count_spawns() -> Iterator[Spawns]:
+    """Count the processes spawned within the context, and by whom."""
+    spawns = Spawns()
+    with ExitStack() as stack:
+        for name in HOOK_TOOLS:
+            method = getattr(_MockModelBackend, name)
+            stack.enter_context(patch.object(_MockModelBackend, name, _counting(spawns, name, method)))
+        _active.append(spawns)
+        stack.callback(_active.remove, spawns)
+        yield spawns
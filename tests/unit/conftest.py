@@ -0,0 +1,11 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+import fake_snapd as fake_snapd_server
+import pytest
+
+
+@pytest.fixture
+def fake_snapd():
+    """Serve a fake snapd, and point the snap client and the `snap` CLI at it."""
+    with fake_snapd_server.serve() as fake:
+        yield fake
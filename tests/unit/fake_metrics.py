@@ -0,0 +1,36 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""In-process stand-in for the metrics endpoint of parca-agent, checked by its health probe."""
+
+import http.server
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+from unittest.mock import patch
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        self.send_response(200 if self.path == "/metrics" else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve() -> Iterator[str]:
+    """Serve metrics on a free local port, and point the health probe of parca-agent at them."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    ).start()
+    url = f"http://127.0.0.1:{server.server_port}/metrics"
+    try:
+        with patch("parca_agent.METRICS_URL", url):
+            yield url
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,504 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""In-process stand-in for snapd, serving its REST API on a unix socket.
+
+It covers the parts of the API used by the charm, through `snap_client`: installed snaps, their
+apps and configuration, installs from the store and async changes. Each endpoint can be given a
+latency and made to fail, and async changes can be made to take several polls to complete, or
+to fail.
+
+Commands still going through the `snap` CLI are served by a shim executable, which forwards its
+arguments to the fake over the same socket.
+"""
+
+import base64
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from unittest.mock import patch
+
+import snap_client
+
+# a timestamp far enough in the future for snapd to report a hold as "forever"
+HOLD_FOREVER = "2315-06-19T13:00:37Z"
+
+_CLI_SHIM = """#!{python}
+import http.client, json, socket, sys
+
+
+class Connection(http.client.HTTPConnection):
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect({socket_path!r})
+
+
+connection = Connection("localhost")
+connection.request("POST", "/fake/cli", json.dumps(sys.argv[1:]))
+result = json.loads(connection.getresponse().read())["result"]
+sys.stdout.write(result["stdout"])
+sys.stderr.write(result["stderr"])
+sys.exit(result["code"])
+"""
+
+
+class SnapdError(Exception):
+    """An error snapd answers a request with."""
+
+    def __init__(self, status: int, message: str, kind: str = ""):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.kind = kind
+
+
+class _Change:
+    def __init__(self, id: str, kind: str, summary: str, apply: Callable[[], None], polls: int):
+        self.id = id
+        self.kind = kind
+        self.summary = summary
+        self.apply = apply
+        self.polls_left = polls
+        self.err: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.polls_left <= 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        if not self.ready:
+            status, progress = "Doing", {"label": "", "done": 0, "total": 1}
+        elif self.err:
+            status, progress = "Error", {"label": "", "done": 1, "total": 1}
+        else:
+            status, progress = "Done", {"label": "", "done": 1, "total": 1}
+        change = {
+            "id": self.id,
+            "kind": self.kind,
+            "summary": self.summary,
+            "status": status,
+            "ready": self.ready,
+            "tasks": [{"kind": self.kind, "summary": self.summary, "status": status, "progress": progress}],
+        }
+        if self.err:
+            change["err"] = self.err
+        return change
+
+
+class FakeSnapd:
+    """The state of a fake snapd, and the server exposing it.
+
+    Attributes:
+        snaps: the installed snaps, by name, as described by `GET /v2/snaps/{name}`, plus the
+            "config" of each snap.
+        store: the snaps available in the store, by name, as described by `GET /v2/snaps/{name}`
+            once installed.
+        latency: seconds to wait before answering a request to an endpoint.
+        change_polls: number of polls after which an async change is ready (and takes effect).
+        requests: the (method, path) of every request received.
+        connections: the number of connections accepted.
+        snap_actions: the (snap, action) of every `POST /v2/snaps/{name}`, e.g. an install or
+            refresh from the store.
+        cli_calls: the arguments of every `snap` CLI invocation.
+        assertions: the assertions acknowledged with `snap ack`.
+
+    Endpoints are named after the first component of their path ("snaps", "apps", "changes"),
+    except for snap configuration ("conf") and the CLI shim ("cli").
+    """
+
+    def __init__(self, socket_path: str, bin_dir: Path):
+        self.socket_path = socket_path
+        self.bin_dir = bin_dir
+        self.cli_path = bin_dir / "snap"
+        self.snaps: Dict[str, Dict[str, Any]] = {}
+        self.store: Dict[str, Dict[str, Any]] = {}
+        self.latency: Dict[str, float] = {}
+        self.change_polls = 0
+        self.requests: List[Tuple[str, str]] = []
+        self.connections = 0
+        self.snap_actions: List[Tuple[str, str]] = []
+        self.cli_calls: List[List[str]] = []
+        self.assertions: List[Dict[str, str]] = []
+        self._failures: Dict[str, List[Any]] = {}
+        self._change_failures: Dict[str, str] = {}
+        self._changes: Dict[str, _Change] = {}
+        self._lock = threading.RLock()
+        self._server: Optional[socketserver.UnixStreamServer] = None
+
+        bin_dir.mkdir(parents=True, exist_ok=True)
+        self.cli_path.write_text(_CLI_SHIM.format(python=sys.executable, socket_path=socket_path))
+        self.cli_path.chmod(0o755)
+
+    # === STATE SETUP === #
+    def add_store_snap(
+        self,
+        name: str,
+        revision: int,
+        version: str = "1.0",
+        channel: str = "latest/stable",
+        confinement: str = "strict",
+        services: Tuple[str, ...] = (),
+    ):
+        """Make a snap available in the store, with the given daemon services."""
+        self.store[name] = {
+            "name": name,
+            "revision": str(revision),
+            "version": version,
+            "channel": channel,
+            "confinement": confinement,
+            "apps": [{"snap": name, "name": s, "daemon": "simple"} for s in services],
+        }
+
+    def add_installed_snap(
+        self, name: str, revision: Optional[int] = None, config: Optional[Dict[str, Any]] = None
+    ):
+        """Install a snap from the store, as if done before the test started."""
+        self._install(name, revision and str(revision))
+        self.snaps[name]["config"].update(config or {})
+
+    def download(self, name: str, directory: Path) -> Tuple[Path, Path]:
+        """Download a snap from the store, with its assertions, as `snap download` does."""
+        info = self.store[name]
+        snap_file = directory / f"{name}_{info['revision']}.snap"
+        snap_file.write_bytes(f"{name} {info['version']}".encode() * 1024)
+        digest = hashlib.sha3_384(snap_file.read_bytes()).digest()
+        assertions = [
+            {"type": "snap-declaration", "snap-id": f"{name}-id", "snap-name": name},
+            {
+                "type": "snap-revision",
+                "snap-id": f"{name}-id",
+                "snap-revision": info["revision"],
+                "snap-sha3-384": base64.urlsafe_b64encode(digest).decode().rstrip("="),
+            },
+        ]
+        assert_file = snap_file.with_suffix(".assert")
+        assert_file.write_text(
+            "".join(
+                "".join(f"{k}: {v}\n" for k, v in assertion.items()) + "\nc2lnbmF0dXJl\n\n"
+                for assertion in assertions
+            )
+        )
+        return snap_file, assert_file
+
+    def fail(self, endpoint: str, status: int = 500, message: str = "internal error", times: int = 1):
+        """Answer the next `times` requests to an endpoint (or all, if -1) with an error."""
+        self._failures[endpoint] = [status, message, times]
+
+    def fail_change(self, kind: str, err: str = "cannot perform the change"):
+        """Make the next async change of a kind (e.g. "install") fail once it is ready."""
+        self._change_failures[kind] = err
+
+    # === SERVER === #
+    def start(self):
+        """Start serving the snapd API on the socket, in a background thread."""
+        self._server = _UnixServer(self.socket_path, self._handler_class())
+        threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        ).start()
+
+    def stop(self):
+        """Stop serving."""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(_SnapdHandler):
+            snapd = fake
+
+        return Handler
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: Any) -> Tuple[int, Dict]:
+        """Serve a request; return the response status and body."""
+        self.requests.append((method, path))
+        endpoint = _endpoint(path)
+        time.sleep(self.latency.get(endpoint, 0))
+        with self._lock:
+            try:
+                self._maybe_fail(endpoint)
+                result = self._route(method, path.split("/")[2:], query, body)
+            except SnapdError as e:
+                return e.status, {
+                    "type": "error",
+                    "status-code": e.status,
+                    "result": {"message": e.message, "kind": e.kind},
+                }
+        if isinstance(result, _Change):
+            return 202, {"type": "async", "status-code": 202, "change": result.id, "result": None}
+        return 200, {"type": "sync", "status-code": 200, "result": result}
+
+    def _maybe_fail(self, endpoint: str):
+        failure = self._failures.get(endpoint)
+        if not failure or failure[2] == 0:
+            return
+        failure[2] -= 1
+        raise SnapdError(failure[0], failure[1])
+
+    def _route(self, method: str, parts: List[str], query: Dict[str, str], body: Any):  # noqa: C901
+        if parts[0] == "cli":
+            return self._cli(body)
+        if parts[0] == "snaps" and len(parts) == 2:
+            if method == "GET":
+                return self._snap_info(parts[1])
+            return self._snap_action(parts[1], body)
+        if parts[0] == "snaps" and parts[2:] == ["conf"]:
+            config = self._installed(parts[1])["config"]
+            if method == "GET":
+                keys = query.get("keys")
+                return {k: v for k, v in config.items() if not keys or k in keys.split(",")}
+            return self._change("configure", parts[1], lambda: _update_config(config, body))
+        if parts == ["apps"] and method == "GET":
+            names = query.get("names", "").split(",")
+            return [app for name in names for app in self._installed(name)["apps"]]
+        if parts == ["apps"]:
+            return self._apps_action(body)
+        if parts[0] == "changes" and len(parts) == 2:
+            return self._poll_change(parts[1])
+        raise SnapdError(404, "not found")
+
+    # === SNAPS === #
+    def _installed(self, name: str) -> Dict[str, Any]:
+        if name not in self.snaps:
+            raise SnapdError(404, f'snap "{name}" is not installed', "snap-not-found")
+        return self.snaps[name]
+
+    def _snap_info(self, name: str) -> Dict[str, Any]:
+        info = dict(self._installed(name))
+        info.pop("config")
+        return info
+
+    def _install(self, name: str, revision: Optional[str]):
+        if name not in self.store:
+            raise SnapdError(404, "snap not found", "snap-not-found")
+        info = json.loads(json.dumps(self.store[name]))
+        info["revision"] = revision or info["revision"]
+        info["status"] = "active"
+        for app in info["apps"]:
+            # snapd enables and starts services on install
+            app.update(enabled=True, active=True)
+        info["config"] = self.snaps.get(name, {}).get("config", {})
+        self.snaps[name] = info
+        # the snap's command, as snapd puts it on the PATH, which only reports its version
+        command = self.bin_dir / name
+        command.write_text(f"#!/bin/sh\necho '{name}, version {info['version']} (commit: 0)'\n")
+        command.chmod(0o755)
+
+    def _remove(self, name: str):
+        self.snaps.pop(name)
+        (self.bin_dir / name).unlink()
+
+    def _snap_action(self, name: str, body: Dict[str, Any]) -> _Change:
+        action = body["action"]
+        self.snap_actions.append((name, action))
+        if action == "install":
+            if name not in self.store:
+                raise SnapdError(404, "snap not found", "snap-not-found")
+            self._check_classic(name, body)
+            return self._change(action, name, lambda: self._install(name, body.get("revision")))
+
+        info = self._installed(name)
+        if action == "refresh":
+            # a refresh carries the consent to classic confinement over, but can't give it
+            if info["confinement"] != "classic":
+                self._check_classic(name, body)
+            revision = body.get("revision")
+            return self._change(action, name, lambda: self._install(name, revision))
+        if action == "remove":
+            return self._change(action, name, lambda: self._remove(name))
+        if action == "hold":
+            return self._change(action, name, lambda: info.update(hold=HOLD_FOREVER))
+        raise SnapdError(400, f"unknown action {action!r}")
+
+    def _check_classic(self, name: str, body: Dict[str, Any]):
+        if self.store[name]["confinement"] == "classic" and not body.get("classic"):
+            raise SnapdError(
+                400, f'snap "{name}" requires classic confinement', "snap-needs-classic"
+            )
+
+    def _apps_action(self, body: Dict[str, Any]) -> _Change:
+        action = body["action"]
+        apps = []
+        for name in body["names"]:
+            snap_name, _, app_name = name.partition(".")
+            apps.extend(
+                app
+                for app in self._installed(snap_name)["apps"]
+                if "daemon" in app and app_name in ("", app["name"])
+            )
+
+        def apply():
+            for app in apps:
+                app["active"] = action != "stop"
+                if body.get("enable"):
+                    app["enabled"] = True
+                if body.get("disable"):
+                    app["enabled"] = False
+
+        return self._change(action, ",".join(body["names"]), apply)
+
+    # === CHANGES === #
+    def _change(self, kind: str, target: str, apply: Callable[[], Any]) -> _Change:
+        change = _Change(
+            str(len(self._changes) + 1), kind, f"{kind} {target}", apply, self.change_polls
+        )
+        self._changes[change.id] = change
+        if change.ready:
+            self._complete(change)
+        return change
+
+    def _poll_change(self, change_id: str) -> Dict[str, Any]:
+        if change_id not in self._changes:
+            raise SnapdError(404, f"cannot find change with id {change_id!r}")
+        change = self._changes[change_id]
+        if not change.ready:
+            change.polls_left -= 1
+            if change.ready:
+                self._complete(change)
+        return change.as_dict()
+
+    def _complete(self, change: _Change):
+        if change.kind in self._change_failures:
+            change.err = self._change_failures.pop(change.kind)
+            return
+        change.apply()
+
+    # === CLI === #
+    def _cli(self, args: List[str]) -> Dict[str, Any]:
+        self.cli_calls.append(args)
+        command = getattr(self, f"_cli_{args[0]}", None) if args else None
+        stdout = command(*args[1:]) if command else ""
+        if isinstance(stdout, dict):
+            return stdout
+        return {"code": 0, "stdout": stdout, "stderr": ""}
+
+    def _cli_download(self, name: str, *args: str) -> Any:
+        options = dict(arg[2:].split("=", 1) for arg in args)
+        revision = self.store[name]["revision"]
+        if options.get("revision", revision) != revision:
+            return {"code": 1, "stdout": "", "stderr": "error: no such revision\n"}
+        self.download(name, Path(options.get("target-directory", ".")))
+        return ""
+
+    def _cli_ack(self, assert_file: str) -> str:
+        for block in Path(assert_file).read_text().split("\n\n"):
+            if block.startswith("type: "):
+                self.assertions.append(dict(line.split(": ", 1) for line in block.splitlines()))
+        return ""
+
+    def _cli_install(self, *args: str) -> Any:
+        (snap_file,) = (arg for arg in args if not arg.startswith("--"))
+        return self._install_local(Path(snap_file), wait="--no-wait" not in args)
+
+    def _install_local(self, snap_file: Path, wait: bool = True) -> Dict[str, Any]:
+        # like snapd, only install a local snap as if from the store if its assertions are known
+        digest = hashlib.sha3_384(snap_file.read_bytes()).digest()
+        sha3_384 = base64.urlsafe_b64encode(digest).decode().rstrip("=")
+        revisions = [a for a in self.assertions if a.get("snap-sha3-384") == sha3_384]
+        if not revisions:
+            stderr = f'error: cannot find signatures with metadata for snap "{snap_file}"\n'
+            return {"code": 1, "stdout": "", "stderr": stderr}
+        snap_id = revisions[0]["snap-id"]
+        name = next(a["snap-name"] for a in self.assertions if a.get("snap-id") == snap_id)
+        revision = revisions[0]["snap-revision"]
+        if not wait:
+            # like `snap install --no-wait`, print the ID of the change for the caller to track
+            change = self._change("install", name, lambda: self._install(name, revision))
+            return {"code": 0, "stdout": f"{change.id}\n", "stderr": ""}
+        self._install(name, revision)
+        stdout = f"{name} {self.snaps[name]['version']} from Canonical installed\n"
+        return {"code": 0, "stdout": stdout, "stderr": ""}
+
+
+@contextmanager
+def serve() -> Iterator[FakeSnapd]:
+    """Serve a fake snapd, and point the snap client and the `snap` CLI at it.
+
+    Executables added to the `bin_dir` of the fake snapd are also on the PATH.
+    """
+    # unix socket paths are limited to ~100 characters: keep it short
+    tmp_dir = Path(tempfile.mkdtemp(prefix="snapd-"))
+    socket_path = str(tmp_dir / "snapd.socket")
+    fake = FakeSnapd(socket_path, tmp_dir / "bin")
+    fake.start()
+    try:
+        with patch.object(snap_client, "SNAPD_SOCKET", socket_path), patch.object(
+            snap_client, "SNAP_CLI", str(fake.cli_path)
+        ), patch.dict(os.environ, PATH=f"{fake.bin_dir}{os.pathsep}{os.environ['PATH']}"):
+            yield fake
+    finally:
+        pool = snap_client._ConnectionPool._pools.pop(socket_path, None)
+        if pool and pool._connection:
+            pool._connection.close()
+        fake.stop()
+        shutil.rmtree(tmp_dir)
+
+
+def _endpoint(path: str) -> str:
+    parts = path.split("/")[2:]
+    if parts[0] == "snaps" and parts[2:] == ["conf"]:
+        return "conf"
+    return parts[0]
+
+
+def _update_config(config: Dict[str, Any], changes: Dict[str, Any]):
+    for key, value in changes.items():
+        if value is None:
+            config.pop(key, None)
+        else:
+            config[key] = value
+
+
+class _SnapdHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    snapd: FakeSnapd
+
+    def setup(self):
+        super().setup()
+        with self.snapd._lock:
+            self.snapd.connections += 1
+
+    def do_GET(self):  # noqa: N802
+        self._serve()
+
+    def do_POST(self):  # noqa: N802
+        self._serve()
+
+    def do_PUT(self):  # noqa: N802
+        self._serve()
+
+    def _serve(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, response = self.snapd.handle(self.command, url.path, query, body)
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return "fake-snapd"
+
+    def log_message(self, *args):
+        pass
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
@@ -0,0 +1,127 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""The charm events worth measuring, and the machine they are processed on.
+
+Each scenario sets the (fake) machine up, then builds the event and the state of the unit.
+"""
+
+import shutil
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, NamedTuple, Set
+from unittest.mock import patch
+
+import fake_metrics
+import fake_snapd
+from charms.certificate_transfer_interface.v1.certificate_transfer import (
+    ProviderApplicationData,
+)
+from ops.testing import CharmEvents, Relation, Resource
+
+STORE_RELATION = Relation(
+    "parca-store-endpoint",
+    remote_app_data={
+        "remote-store-address": "parca.example.com:443",
+        "remote-store-bearer-token": "foo",
+    },
+)
+CA_RELATION = Relation(
+    "receive-ca-cert",
+    remote_app_name="ca",
+    remote_app_data=ProviderApplicationData(certificates={"ca"}).dump(),
+)
+STORE_CONFIG = {
+    "remote-store-address": "parca.example.com:443",
+    "remote-store-bearer-token": "foo",
+}
+
+
+class Machine(NamedTuple):
+    """The fake snapd and directories of a machine, and the charm resources."""
+
+    snapd: fake_snapd.FakeSnapd
+    ca_dir: Path
+    resources: Set[Resource]
+
+
+@contextmanager
+def machine(ca_dir: Path) -> Iterator[Machine]:
+    """Set up a machine with a fake snapd, from which parca-agent can be installed."""
+    with ExitStack() as stack:
+        snapd = stack.enter_context(fake_snapd.serve())
+        stack.enter_context(fake_metrics.serve())
+        snapd.add_store_snap(
+            "parca-agent",
+            2587,
+            version="v0.35.3",
+            confinement="classic",
+            services=("parca-agent-svc",),
+        )
+        update_ca_certificates = snapd.bin_dir / "update-ca-certificates"
+        update_ca_certificates.write_text("#!/bin/sh\n")
+        update_ca_certificates.chmod(0o755)
+        for name, path in (
+            ("CA_CERTS_PATH", ca_dir / "legacy"),
+            ("CA_BUNDLE_DIR", ca_dir / "bundle"),
+            ("SYSTEM_CERTS_DIR", ca_dir / "certs"),
+            ("SNAP_CACHE_DIR", ca_dir / "snaps"),
+        ):
+            path.mkdir()
+            stack.enter_context(patch(f"parca_agent.{name}", path))
+        stack.enter_context(patch("parca_agent.ARCH", "amd64"))
+        # as served by Charmhub when no snap resource was uploaded
+        snap_resource = ca_dir / "parca-agent-snap.tar"
+        snap_resource.touch()
+        yield Machine(snapd, ca_dir, {Resource(name="parca-agent-snap", path=snap_resource)})
+
+
+def _installed(revision: int = 2587, config: Dict[str, str] = STORE_CONFIG):
+    def setup(machine: Machine):
+        machine.snapd.snaps.clear()
+        machine.snapd.add_installed_snap("parca-agent", revision, config=dict(config))
+        for path in machine.ca_dir.glob("*/*"):
+            # snap downloads left in the background by an earlier run have a directory each
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+    return setup
+
+
+def _not_installed(machine: Machine):
+    machine.snapd.snaps.clear()
+
+
+class Scenario(NamedTuple):
+    """How to set the machine up, and which event to process with which relations."""
+
+    setup: Callable[[Machine], None]
+    event: Callable[[CharmEvents], object]
+    relations: Set[Relation]
+    # whether the unit already processed the same event, i.e. has settled
+    settled: bool = False
+
+
+SCENARIOS = {
+    "install": Scenario(_not_installed, lambda on: on.install(), {STORE_RELATION}),
+    "start": Scenario(_installed(), lambda on: on.start(), {STORE_RELATION}),
+    "upgrade-charm": Scenario(
+        _installed(revision=2500), lambda on: on.upgrade_charm(), {STORE_RELATION}
+    ),
+    "update-status": Scenario(
+        _installed(), lambda on: on.update_status(), {STORE_RELATION}, settled=True
+    ),
+    "parca-store-endpoint-relation-changed": Scenario(
+        _installed(config={}),
+        lambda on: on.relation_changed(STORE_RELATION, remote_unit=0),
+        {STORE_RELATION},
+    ),
+    "receive-ca-cert-relation-changed": Scenario(
+        _installed(),
+        lambda on: on.relation_changed(CA_RELATION, remote_unit=0),
+        {STORE_RELATION, CA_RELATION},
+    ),
+    "remove": Scenario(_installed(), lambda on: on.remove(), {STORE_RELATION}),
+}
@@ -0,0 +1,35 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Measure what importing the charm costs, as at the start of every hook."""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict
+
+ROOT = Path(__file__).parents[2]
+
+
+def import_times() -> Dict[str, float]:
+    """Import the charm in a fresh interpreter and return the cumulative import time per module."""
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(str(ROOT / p) for p in ("", "lib", "src")),
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import charm"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        times[module.strip()] = int(cumulative) / 1e6
+    return times
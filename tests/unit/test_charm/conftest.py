@@ -16,12 +16,19 @@ def patch_buffer_file_for_charm_tracing(tmp_path):
         yield
 
 
+@pytest.fixture(autouse=True)
+def patch_snap_cache_dir(tmp_path):
+    with patch("parca_agent.SNAP_CACHE_DIR", tmp_path / "snap-cache"):
+        yield
+
+
 @pytest.fixture
 def context():
     return Context(ParcaAgentOperatorCharm)
 
 
-@pytest.fixture(autouse=True, scope="session")
+# not session-scoped: its patches would outlive this directory, into every test collected after
+@pytest.fixture(autouse=True)
 def patch_all():
     with ExitStack() as stack:
         stack.enter_context(
@@ -32,7 +39,7 @@ def patch_all():
         )
         stack.enter_context(
             patch(
-                "charms.operator_libs_linux.v1.snap.Snap.present",
+                "snap_client.Snap.present",
                 True,
             )
         )
@@ -1,6 +1,9 @@
 # Copyright 2023 Jon Seager
 # See LICENSE file for licensing details.
+import dataclasses
+import json
 import tempfile
+import time
 from contextlib import ExitStack
 from pathlib import Path
 
@@ -16,14 +19,29 @@ from charms.certificate_transfer_interface.v1.certificate_transfer import (
     ProviderApplicationData,
 )
 from charms.operator_libs_linux.v1 import snap
-from ops.model import ActiveStatus, BlockedStatus
-from ops.testing import CharmEvents, Relation, State, TCPPort
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.testing import (
+    ActionFailed,
+    CharmEvents,
+    Context,
+    Relation,
+    State,
+    StoredState,
+    TCPPort,
+)
+
+import snap_client
+from charm import TRACING_MARKER, ParcaAgentOperatorCharm, _charm_type
 
 
 @pytest.fixture(autouse=True)
 def patch_all():
     with ExitStack() as stack:
-        stack.enter_context(patch("charm.ParcaAgent._reconcile_config", lambda _: None))
+        stack.enter_context(patch("charm.ParcaAgent._plan_config", lambda _: {}))
+        # no snap resource attached: install from the store
+        stack.enter_context(patch("charm.ParcaAgentOperatorCharm._snap_resource", lambda _: None))
+        # parca-agent answers its health probe
+        stack.enter_context(patch("charm.ParcaAgent.probe", lambda _: True))
         yield
 
 
@@ -52,8 +70,8 @@ def store_relation():
         (CharmEvents().update_status()),
     ),
 )
-@patch("charm.ParcaAgent.install", lambda _: True)
-@patch("charm.ParcaAgent.refresh", lambda _: True)
+@patch("charm.ParcaAgent.install", lambda _, resource=None: True)
+@patch("charm.ParcaAgent.refresh", lambda _, resource=None: True)
 @patch("charm.ParcaAgent.installed", True)
 @patch("charm.ParcaAgent.running", True)
 @patch("charm.ParcaAgent.revision", 2587)
@@ -69,9 +87,28 @@ def test_happy_path_status(context, event, store_relation):
     assert state_out.workload_version == "v0.12.0"
 
 
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+def test_status_set_after_failed_hook(context, store_relation):
+    # GIVEN a hook set the unit status, then failed, rolling back its stored state to when the
+    # unit was active
+    stored = StoredState(owner_path="ParcaAgentOperatorCharm", content={"unit_status": ["active", ""]})
+    state = State(
+        relations={store_relation},
+        stored_states={stored},
+        unit_status=MaintenanceStatus("refreshing parca-agent"),
+    )
+    # WHEN the next event fires
+    state_out = context.run(context.on.update_status(), state)
+    # THEN the status is set again
+    assert state_out.unit_status == ActiveStatus("")
+
+
 @patch("charm.ParcaAgent.version", "v0.12.0")
-@patch("charm.ParcaAgent.install", lambda _: True)
-@patch("charm.ParcaAgent.refresh", lambda _: True)
+@patch("charm.ParcaAgent.install", lambda _, resource=None: True)
+@patch("charm.ParcaAgent.refresh", lambda _, resource=None: True)
 @pytest.mark.parametrize(
     "event",
     (
@@ -111,6 +148,8 @@ def test_snap_operation_error_set_blocked(install, refresh, context, event, erro
 @patch("charm.ParcaAgent.revision", 2587)
 @patch("charm.ParcaAgent.version", "v0.12.0")
 @patch("parca_agent.ParcaAgent._snap")
+# don't go to the store ahead of the refresh: the snap is refreshed in place
+@patch("parca_agent._start_download", MagicMock(side_effect=snap.SnapError("no network")))
 def test_update_status_refreshes_snap_hold(snap, context):
     state_out = context.run(context.on.install(), State())
     snap.hold.assert_called_once()
@@ -118,6 +157,7 @@ def test_update_status_refreshes_snap_hold(snap, context):
 
 
 @patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
 @patch("charm.ParcaAgent.revision", 2587)
 @patch("charm.ParcaAgent.version", "v0.12.0")
 @patch("charm.ParcaAgent.start")
@@ -150,8 +190,8 @@ def test_remove(parca_stop, context, store_relation):
 @patch("charm.ParcaAgent.running", True)
 @patch("charm.ParcaAgent.revision", 2587)
 @patch("charm.ParcaAgent.version", "v0.12.0")
-@patch("charm.ParcaAgent.install", lambda _: True)
-@patch("charm.ParcaAgent.refresh", lambda _: True)
+@patch("charm.ParcaAgent.install", lambda _, resource=None: True)
+@patch("charm.ParcaAgent.refresh", lambda _, resource=None: True)
 def test_parca_external_store_relation_join(context):
     # GIVEN we are leader and have a store relation
     store_config = {
@@ -220,7 +260,9 @@ def test_parca_external_store_relation_removed(context, remote_data_present):
     "parca_agent.CA_CERTS_PATH",
     new_callable=lambda: Path(tempfile.TemporaryDirectory().name),
 )
-def test_parca_receive_ca_cert(mock_dir, context, store_relation):
+@patch("parca_agent.CA_BUNDLE_DIR", new_callable=lambda: Path(tempfile.mkdtemp()))
+@patch("parca_agent.SYSTEM_CERTS_DIR", new_callable=lambda: Path(tempfile.mkdtemp()))
+def test_parca_receive_ca_cert(certs_dir, _, __, context, store_relation):
     # GIVEN parca-agent is connected to multiple CA transfer providers
     ca_transfer_relation = Relation(
         "receive-ca-cert",
@@ -240,8 +282,8 @@ def test_parca_receive_ca_cert(mock_dir, context, store_relation):
         ),
     )
 
-    # THEN CAs are flushed into one ca file
-    ca_path = mock_dir / "receive-ca-cert-parca-agent-ca.crt"
+    # THEN CAs are flushed into one ca file, trusted by parca-agent
+    ca_path = certs_dir / "receive-ca-cert-parca-agent-ca.crt"
     assert ca_path.read_text() == "ca1\n\nca2\n\n"
 
     # GIVEN A CA transfer provider is broken
@@ -255,3 +297,373 @@ def test_parca_receive_ca_cert(mock_dir, context, store_relation):
 
     # THEN only 1 CA is flushed into the ca file
     assert ca_path.read_text() == "ca2\n\n"
+
+
+@patch("charm.ParcaAgent._snap", MagicMock())
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+def test_unchanged_ca_certs_not_parsed(context, store_relation, tmp_path):
+    from charms.certificate_transfer_interface.v1.certificate_transfer import (
+        CertificateTransferRequires,
+    )
+
+    ca_transfer_relation = Relation(
+        "receive-ca-cert",
+        remote_app_name="ca",
+        remote_app_data=ProviderApplicationData(certificates={"ca"}).dump(),
+    )
+    get_all_certificates = CertificateTransferRequires.get_all_certificates
+    with patch("parca_agent.CA_BUNDLE_DIR", tmp_path), patch(
+        "parca_agent.SYSTEM_CERTS_DIR", tmp_path / "certs"
+    ), patch.object(
+        CertificateTransferRequires,
+        "get_all_certificates",
+        autospec=True,
+        side_effect=get_all_certificates,
+    ) as get_certs:
+        (tmp_path / "certs").mkdir()
+        # GIVEN the unit trusts the CA certificates it received
+        state = context.run(
+            context.on.relation_changed(ca_transfer_relation),
+            State(leader=True, relations={store_relation, ca_transfer_relation}),
+        )
+        get_certs.reset_mock()
+        # WHEN another event fires, with the same certificates
+        context.run(context.on.update_status(), state)
+
+    # THEN they aren't parsed again
+    get_certs.assert_not_called()
+
+
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+def test_cos_agent_loaded_when_related(store_relation, tmp_path):
+    context = Context(ParcaAgentOperatorCharm, charm_root=tmp_path)
+    # GIVEN parca-agent is related to a COS agent
+    cos_agent_relation = Relation("cos-agent", remote_app_name="opentelemetry-collector")
+    # WHEN the relation joins
+    state_out = context.run(
+        context.on.relation_joined(cos_agent_relation),
+        State(leader=True, relations={store_relation, cos_agent_relation}),
+    )
+    # THEN the metrics endpoint is published to it
+    config = json.loads(state_out.get_relation(cos_agent_relation.id).local_unit_data["config"])
+    (job,) = config["metrics_scrape_jobs"]
+    assert job["static_configs"][0]["targets"] == ["localhost:7071"]
+    # AND the provider is traced, although loaded after the charm type was instrumented
+    from charms.grafana_agent.v0.cos_agent import COSAgentProvider
+
+    assert COSAgentProvider._on_refresh.__wrapped__
+    assert not hasattr(COSAgentProvider._on_refresh.__wrapped__, "__wrapped__")
+    # AND the next hooks are traced, until the relation is gone
+    assert (tmp_path / TRACING_MARKER).exists()
+    context.run(context.on.update_status(), State(leader=True, relations={store_relation}))
+    assert not (tmp_path / TRACING_MARKER).exists()
+
+
+def test_charm_only_traced_when_related_to_cos_agent(tmp_path):
+    with patch("charms.tempo_coordinator_k8s.v0.charm_tracing.trace_charm") as trace_charm:
+        # GIVEN the unit isn't related to a COS agent
+        # THEN the hook is dispatched to the charm as is
+        assert _charm_type(tmp_path) is ParcaAgentOperatorCharm
+        trace_charm.assert_not_called()
+        # GIVEN it was related to a COS agent as of the last hook
+        (tmp_path / TRACING_MARKER).touch()
+        # THEN the hook is dispatched to the traced charm
+        assert _charm_type(tmp_path) is trace_charm.return_value.return_value
+        trace_charm.return_value.assert_called_once_with(ParcaAgentOperatorCharm)
+
+
+@patch("charm.ParcaAgent.installed", False)
+@patch("charm.ParcaAgent.start")
+@patch("parca_agent.snap_client.get_change")
+def test_snap_change_in_progress(get_change, parca_start, context, store_relation):
+    # GIVEN a snap install that was still in progress at the end of the install hook
+    get_change.return_value = snap_client.SnapChange(
+        "42",
+        ready=False,
+        tasks=[{"summary": "Download snap", "status": "Doing", "progress": {"done": 1, "total": 2}}],
+    )
+    stored = StoredState(
+        owner_path="ParcaAgentOperatorCharm",
+        content={"parca_agent": {"pending-change": {"id": "42", "operation": "install"}}},
+    )
+    # WHEN the start event fires
+    state_out = context.run(
+        context.on.start(), State(relations={store_relation}, stored_states={stored})
+    )
+    # THEN the agent is started later, and the unit reports the install progress
+    parca_start.assert_not_called()
+    assert len(state_out.deferred) == 1
+    assert state_out.unit_status == MaintenanceStatus(
+        "parca-agent snap install in progress: Download snap (50%)"
+    )
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2500)
+@patch("charm.ParcaAgent.version", "v0.11.0")
+def test_snap_download_in_progress(context, store_relation, tmp_path):
+    # GIVEN the revision to refresh to was still downloading at the end of the upgrade-charm hook
+    pending = {
+        "revision": 2587,
+        "directory": str(tmp_path),
+        "process-group": 0,
+        "operation": "refresh",
+        "since": time.time(),
+    }
+    stored = StoredState(
+        owner_path="ParcaAgentOperatorCharm",
+        content={"parca_agent": {"pending-download": pending}},
+    )
+    # WHEN another event fires before it is done
+    state_out = context.run(
+        context.on.update_status(), State(relations={store_relation}, stored_states={stored})
+    )
+    # THEN the unit reports the download, rather than a revision mismatch
+    assert state_out.unit_status == MaintenanceStatus(
+        "parca-agent snap downloading revision 2587 to refresh to"
+    )
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+def test_workload_version_only_set_when_changed(context, store_relation):
+    # GIVEN the workload version was already set in an earlier hook
+    stored = StoredState(owner_path="ParcaAgentOperatorCharm", content={"workload_version": "v0.12.0"})
+    # WHEN any event fires
+    state_out = context.run(
+        context.on.update_status(), State(relations={store_relation}, stored_states={stored})
+    )
+    # THEN the workload version isn't set again
+    assert state_out.workload_version == ""
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+def test_workload_version_set_without_store(context):
+    # GIVEN there is no store relation
+    # WHEN any event fires
+    state_out = context.run(context.on.update_status(), State())
+    # THEN the unit is blocked, but reports the version installed
+    assert_blocked_no_store(state_out)
+    assert state_out.workload_version == "v0.12.0"
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.reconcile")
+def test_reconcile_skipped_when_desired_state_unchanged(reconcile, context, store_relation):
+    # GIVEN the charm reconciled in an earlier hook
+    state_out = context.run(context.on.update_status(), State(relations={store_relation}))
+    reconcile.assert_called_once()
+
+    # WHEN a later hook has the same inputs
+    state_out = context.run(
+        context.on.update_status(),
+        State(relations={store_relation}, stored_states=state_out.stored_states),
+    )
+    # THEN the reconcile is skipped
+    reconcile.assert_called_once()
+
+    # WHEN the store config changes
+    store_relation = dataclasses.replace(
+        store_relation, remote_app_data={"remote-store-address": "198.51.100.0:443"}
+    )
+    context.run(
+        context.on.relation_changed(store_relation),
+        State(relations={store_relation}, stored_states=state_out.stored_states),
+    )
+    # THEN the charm reconciles again
+    assert reconcile.call_count == 2
+
+
+@patch("parca_agent.ARCH", "amd64")
+def test_lifecycle_against_fake_snapd(fake_snapd, context, store_relation, tmp_path):
+    # GIVEN a machine where snapd can install parca-agent
+    fake_snapd.add_store_snap(
+        "parca-agent",
+        2587,
+        version="v0.35.3",
+        confinement="classic",
+        services=("parca-agent-svc",),
+    )
+    state = State(leader=True, relations={store_relation})
+    # WHEN the charm is installed and started
+    with patch("parca_agent.CA_CERTS_PATH", tmp_path):
+        for event in (context.on.install(), context.on.start(), context.on.update_status()):
+            state = context.run(event, state)
+
+    # THEN the snap is installed, held and running, and the unit is active
+    assert fake_snapd.snaps["parca-agent"]["hold"]
+    assert all(app["active"] for app in fake_snapd.snaps["parca-agent"]["apps"])
+    assert state.workload_version == "v0.35.3"
+    assert state.unit_status == ActiveStatus("")
+
+
+@patch("parca_agent.ARCH", "amd64")
+def test_restart_pending_until_update_status(fake_snapd, context, store_relation, tmp_path):
+    fake_snapd.add_store_snap(
+        "parca-agent", 2587, confinement="classic", services=("parca-agent-svc",)
+    )
+    fake_snapd.add_installed_snap("parca-agent")
+    ca_transfer_relation = Relation(
+        "receive-ca-cert",
+        remote_app_data=ProviderApplicationData(certificates={"ca1"}).dump(),
+    )
+    # WHEN the CA certificates change
+    with patch("parca_agent.CA_BUNDLE_DIR", tmp_path), patch(
+        "parca_agent.SYSTEM_CERTS_DIR", tmp_path / "certs"
+    ):
+        (tmp_path / "certs").mkdir()
+        state = context.run(
+            context.on.relation_changed(ca_transfer_relation, remote_unit=0),
+            State(leader=True, relations={store_relation, ca_transfer_relation}),
+        )
+        # THEN the restart of parca-agent is debounced
+        assert state.unit_status == WaitingStatus("restart pending")
+        assert ("POST", "/v2/apps") not in fake_snapd.requests
+
+        # WHEN update-status fires
+        state = context.run(context.on.update_status(), state)
+    # THEN parca-agent is restarted
+    assert fake_snapd.requests.count(("POST", "/v2/apps")) == 1
+    assert state.unit_status == ActiveStatus("")
+
+
+@patch("parca_agent.ARCH", "amd64")
+def test_configured_on_start_without_debounce(fake_snapd, context, store_relation, tmp_path):
+    fake_snapd.add_store_snap(
+        "parca-agent", 2587, confinement="classic", services=("parca-agent-svc",)
+    )
+    # GIVEN snapd started parca-agent when installing it, before it was configured
+    fake_snapd.add_installed_snap("parca-agent")
+    ca_transfer_relation = Relation(
+        "receive-ca-cert",
+        remote_app_data=ProviderApplicationData(certificates={"ca1"}).dump(),
+    )
+    # WHEN the unit starts
+    with patch("parca_agent.CA_BUNDLE_DIR", tmp_path), patch(
+        "parca_agent.SYSTEM_CERTS_DIR", tmp_path / "certs"
+    ):
+        (tmp_path / "certs").mkdir()
+        state = context.run(
+            context.on.start(),
+            State(leader=True, relations={store_relation, ca_transfer_relation}),
+        )
+        # THEN parca-agent is configured, and restarted right away to pick its config up
+        assert (tmp_path / "certs" / "receive-ca-cert-parca-agent-ca.crt").exists()
+    assert fake_snapd.requests.count(("POST", "/v2/apps")) == 1
+    assert state.unit_status == ActiveStatus("")
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.start", MagicMock())
+@patch("charm.ParcaAgent.reconcile", return_value=[])
+def test_reconcile_scoped_to_event(reconcile, context, store_relation):
+    ca_transfer_relation = Relation(
+        "receive-ca-cert",
+        remote_app_data=ProviderApplicationData(certificates={"ca1"}).dump(),
+    )
+    # GIVEN the charm fully reconciled in an earlier hook
+    state = context.run(
+        context.on.start(), State(relations={store_relation, ca_transfer_relation})
+    )
+    reconcile.assert_called_once_with(certificates=True, store=True)
+
+    # WHEN the CA certificates change
+    ca_transfer_relation = dataclasses.replace(
+        ca_transfer_relation,
+        remote_app_data=ProviderApplicationData(certificates={"ca2"}).dump(),
+    )
+    state = context.run(
+        context.on.relation_changed(ca_transfer_relation, remote_unit=0),
+        dataclasses.replace(state, relations={store_relation, ca_transfer_relation}),
+    )
+    # THEN only the CA certificates are reconciled
+    reconcile.assert_called_with(certificates=True, store=False)
+
+    # WHEN the store relation changes, but not its data
+    context.run(context.on.relation_changed(store_relation, remote_unit=0), state)
+    # THEN nothing is reconciled
+    assert reconcile.call_count == 2
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.start", MagicMock())
+@patch("charm.ParcaAgent.reconcile", return_value=["store config (remote-store-address)"])
+def test_reconcile_action(reconcile, context, store_relation):
+    # GIVEN the charm reconciled in an earlier hook
+    state = context.run(context.on.start(), State(relations={store_relation}))
+    # WHEN the reconcile action is run, although nothing seems to have changed
+    context.run(context.on.action("reconcile"), state)
+    # THEN the charm reconciles in full, and reports what changed
+    assert reconcile.call_count == 2
+    reconcile.assert_called_with(certificates=True, store=True)
+    assert context.action_results == {"changed": "store config (remote-store-address)"}
+
+
+@patch("charm.ParcaAgent.installed", False)
+def test_reconcile_action_fails_if_not_installed(context, store_relation):
+    with pytest.raises(ActionFailed, match="not installed"):
+        context.run(context.on.action("reconcile"), State(relations={store_relation}))
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.ensure_held")
+@patch("charm.ParcaAgent.reconcile", return_value=[])
+def test_update_status_deep_checks_every_nth(reconcile, ensure_held, context, store_relation):
+    # GIVEN the charm reconciled in the first update-status
+    state = context.run(
+        context.on.update_status(),
+        State(relations={store_relation}, config={"deep-check-interval": 3}),
+    )
+    reconcile.reset_mock()
+    # WHEN two more update-status fire
+    for _ in range(2):
+        state = context.run(context.on.update_status(), state)
+    # THEN only the third deep checks the agent
+    reconcile.assert_called_once_with(certificates=True, store=True)
+    ensure_held.assert_called_once()
+
+
+@patch("charm.ParcaAgent.installed", True)
+@patch("charm.ParcaAgent.running", True)
+@patch("charm.ParcaAgent.revision", 2587)
+@patch("charm.ParcaAgent.version", "v0.12.0")
+@patch("charm.ParcaAgent.probe", lambda _: False)
+@patch("charm.ParcaAgent.ensure_held")
+@patch("charm.ParcaAgent.reconcile", return_value=[])
+def test_update_status_deep_checks_if_probe_fails(reconcile, ensure_held, context, store_relation):
+    # GIVEN the charm reconciled in an earlier hook
+    stored = StoredState(
+        owner_path="ParcaAgentOperatorCharm",
+        content={"reconciled_fingerprints": {"store": "x"}, "reconciled_at": time.time()},
+    )
+    # WHEN update-status fires, and parca-agent fails its health probe
+    context.run(
+        context.on.update_status(), State(relations={store_relation}, stored_states={stored})
+    )
+    # THEN the agent is deep checked
+    reconcile.assert_called_once_with(certificates=True, store=True)
+    ensure_held.assert_called_once()
@@ -0,0 +1,25 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+import pytest
+from import_timer import import_times
+
+# Modules only needed when the charm is related to a COS agent (cosl, and the opentelemetry SDK
+# charm tracing exports spans with) or a CA provider (pydantic), which every hook would
+# otherwise pay for at dispatch. ops imports the opentelemetry API on its own.
+LAZY_MODULES = (
+    "pydantic",
+    "cosl",
+    "charms.tempo_coordinator_k8s.v0.charm_tracing",
+    "opentelemetry.sdk",
+    "opentelemetry.exporter.otlp.proto.http",
+)
+
+
+@pytest.fixture(scope="module")
+def imported():
+    return import_times()
+
+
+@pytest.mark.parametrize("module", LAZY_MODULES)
+def test_heavy_libs_not_imported(imported, module):
+    assert module not in imported
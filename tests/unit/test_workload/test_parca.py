@@ -1,15 +1,19 @@
 # Copyright 2023 Jon Seager
 # See LICENSE file for licensing details.
 
-from unittest.mock import patch
+import time
+from unittest.mock import MagicMock, patch
 
+import pytest
 from charms.operator_libs_linux.v1 import snap
 
-from parca_agent import ParcaAgent
+import snap_client
+from parca_agent import ParcaAgent, get_system_arch
 
 
 @patch("parca_agent.check_output")
 @patch("parca_agent.ParcaAgent.installed", True)
+@patch("parca_agent.ParcaAgent._snap", MagicMock(version=None, revision=2587))
 def test_parca_version_next(checko):
     checko.return_value = (
         b"parca-agent, version v0.12.0-next (commit: e888718c206a5dd63d476849c7349a0352547f1a)\n"
@@ -25,3 +29,181 @@ def test_parca_agent_version_not_installed():
         parca_agent.version
     except snap.SnapError as e:
         assert str(e) == "parca agent snap not installed, cannot fetch version"
+
+
+@patch("parca_agent.snap_client.get_snap")
+def test_snap_lookup_reused_until_mutation(get_snap):
+    get_snap.return_value.known_services = {}
+    parca_agent = ParcaAgent("parca", None, set())
+    # GIVEN several read-only accesses in the same hook
+    parca_agent.installed
+    parca_agent.revision
+    parca_agent.running
+    # THEN snapd is only queried once
+    assert get_snap.call_count == 1
+    assert parca_agent.snapd_calls_saved >= 2
+
+    # WHEN the snap is mutated
+    parca_agent.start()
+    parca_agent.installed
+    # THEN the next access reads the snap state again
+    assert get_snap.call_count == 2
+
+
+@patch("snap_client._snapd_installed", lambda: True)
+@patch("snap_client.SnapClient.get_installed_snap")
+def test_snap_lookup_targets_parca_agent_only(get_installed_snap):
+    get_installed_snap.return_value = {
+        "name": "parca-agent",
+        "channel": "latest/stable",
+        "revision": "2587",
+        "confinement": "classic",
+    }
+    parca_agent = ParcaAgent("parca", None, set())
+    # WHEN the agent inspects its snap
+    assert parca_agent.installed
+    assert parca_agent.revision == 2587
+    # THEN only the parca-agent snap is queried
+    get_installed_snap.assert_called_once_with("parca-agent")
+
+
+@patch("parca_agent.ParcaAgent._snap")
+def test_reconcile_config_single_read_and_write(agent_snap, tmp_path):
+    # GIVEN the snap has part of the store config already applied
+    agent_snap.get_all.return_value = {
+        "remote-store-address": "grpc.polarsignals.com:443",
+        "remote-store-insecure": False,
+    }
+    store_config = {
+        "remote-store-address": "grpc.polarsignals.com:443",
+        "remote-store-insecure": "false",
+        "remote-store-bearer-token": "deadbeef",
+    }
+    parca_agent = ParcaAgent("parca", store_config, set())
+    # WHEN the config is reconciled
+    with patch("parca_agent.CA_CERTS_PATH", tmp_path):
+        parca_agent.reconcile()
+    # THEN the config is read once, and only the changed keys are written at once
+    agent_snap.get_all.assert_called_once()
+    agent_snap.get.assert_not_called()
+    agent_snap.set.assert_called_once_with({"remote-store-bearer-token": "deadbeef"})
+    agent_snap.restart.assert_called_once()
+
+
+@patch("snap_client._snapd_installed", lambda: True)
+@patch("subprocess.Popen")
+@patch("snap_client.SnapClient.get_change")
+@patch("snap_client.SnapClient.put_snap_conf")
+@patch("snap_client.SnapClient.post_apps")
+@patch("snap_client.SnapClient.get_snap_conf")
+@patch("snap_client.SnapClient.get_installed_snap")
+def test_snap_operations_use_snapd_api(
+    get_installed_snap, get_snap_conf, post_apps, put_snap_conf, get_change, subprocess, tmp_path
+):
+    get_installed_snap.return_value = {
+        "name": "parca-agent",
+        "channel": "latest/stable",
+        "revision": "2587",
+        "confinement": "classic",
+    }
+    get_snap_conf.return_value = {}
+    post_apps.return_value = "1"
+    put_snap_conf.return_value = "2"
+    get_change.return_value = {"id": "1", "ready": True, "status": "Done"}
+    parca_agent = ParcaAgent("parca", {"remote-store-address": "foo:443"}, set())
+
+    # WHEN the agent is started and its config changes
+    parca_agent.start()
+    with patch("parca_agent.CA_CERTS_PATH", tmp_path):
+        parca_agent.reconcile()
+
+    # THEN the snapd API is used, and no `snap` process is spawned
+    post_apps.assert_any_call("start", ["parca-agent"], {"enable": True})
+    post_apps.assert_any_call("restart", ["parca-agent"], {"reload": False})
+    put_snap_conf.assert_called_once_with("parca-agent", {"remote-store-address": "foo:443"})
+    assert not subprocess.mock_calls
+
+
+@patch("parca_agent.ParcaAgent.target_revision", 2587)
+@patch("parca_agent.snap_client.get_change")
+@patch("parca_agent.ParcaAgent._snap")
+def test_slow_install_tracked_across_hooks(agent_snap, get_change):
+    # GIVEN snapd doesn't complete the install within the hook
+    agent_snap.present = False
+    agent_snap.ensure.return_value = "42"
+    agent_snap.wait.return_value = snap_client.SnapChange(
+        "42",
+        ready=False,
+        tasks=[
+            {
+                "summary": "Download snap",
+                "status": "Doing",
+                "progress": {"done": 1, "total": 4},
+            }
+        ],
+    )
+    state = {}
+    parca_agent = ParcaAgent("parca", None, set(), state=state, snap_change_timeout=1)
+    # WHEN the snap is installed
+    parca_agent.install()
+    # THEN the change is persisted, reported in progress, and the snap isn't held yet
+    assert state["pending-change"] == {"id": "42", "operation": "install"}
+    assert parca_agent.change_in_progress == "install in progress: Download snap (25%)"
+    agent_snap.hold.assert_not_called()
+
+    # WHEN a later hook finds the change done
+    get_change.return_value = snap_client.SnapChange("42", status="Done", ready=True)
+    parca_agent = ParcaAgent("parca", None, set(), state=state)
+    parca_agent.track_change()
+    # THEN the snap is held and nothing is in progress anymore
+    agent_snap.hold.assert_called_once()
+    assert parca_agent.change_in_progress is None
+
+
+@patch("parca_agent.snap_client.get_change")
+def test_failed_install_reported(get_change):
+    get_change.return_value = snap_client.SnapChange("42", status="Error", ready=True, err="no space")
+    state = {"pending-change": {"id": "42", "operation": "refresh"}}
+    parca_agent = ParcaAgent("parca", None, set(), state=state)
+    with pytest.raises(snap.SnapError, match="no space"):
+        parca_agent.track_change()
+    assert "pending-change" not in state
+
+
+@patch("parca_agent.check_output")
+@patch("parca_agent.ParcaAgent.installed", True)
+@patch("parca_agent.ParcaAgent._snap")
+def test_parca_version_cached_per_revision(agent_snap, checko):
+    checko.return_value = b"parca-agent, version v0.35.3 (commit: deadbeef)\n"
+    agent_snap.revision = 2587
+    state = {}
+    # GIVEN the version was looked up in an earlier hook
+    assert ParcaAgent("parca", None, set(), state=state).version == "v0.35.3"
+    # WHEN a later hook needs it, with the same snap revision
+    assert ParcaAgent("parca", None, set(), state=state).version == "v0.35.3"
+    # AND much later, with the same snap revision
+    with patch("time.time", return_value=time.time() + 365 * 24 * 60 * 60):
+        assert ParcaAgent("parca", None, set(), state=state).version == "v0.35.3"
+    # THEN parca-agent is only run once
+    checko.assert_called_once()
+
+    # WHEN the snap revision changes
+    agent_snap.revision = 2600
+    checko.return_value = b"parca-agent, version v0.36.0 (commit: deadbeef)\n"
+    # THEN the version is looked up again
+    assert ParcaAgent("parca", None, set(), state=state).version == "v0.36.0"
+    assert checko.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "machine, arch",
+    (("x86_64", "amd64"), ("aarch64", "arm64"), ("armv8l", "arm64"), ("riscv64", "riscv64")),
+)
+def test_system_arch(machine, arch):
+    get_system_arch.cache_clear()
+    with patch("os.uname", return_value=MagicMock(machine=machine)) as uname:
+        assert get_system_arch() == arch
+        assert get_system_arch() == arch
+    # THEN the architecture is only looked up once
+    uname.assert_called_once()
+    get_system_arch.cache_clear()
@@ -0,0 +1,478 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# These tests exercise ParcaAgent and the snap client against a fake snapd, rather than mocks.
+import tarfile
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import fake_metrics
+import pytest
+from charms.operator_libs_linux.v1 import snap
+
+import parca_agent as parca_agent_module
+import snap_client
+from parca_agent import AgentState, ParcaAgent, SnapResourceError
+
+STORE_CONFIG = {"remote-store-address": "parca.example.com:443", "remote-store-insecure": "false"}
+
+
+@pytest.fixture(autouse=True)
+def arch():
+    with patch("parca_agent.ARCH", "amd64"):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def ca_dirs(tmp_path):
+    """Keep CA certificates in temporary directories, rather than the system ones."""
+    dirs = {name: tmp_path / name for name in ("legacy", "bundle", "certs")}
+    for path in dirs.values():
+        path.mkdir()
+    with patch("parca_agent.CA_CERTS_PATH", dirs["legacy"]), patch(
+        "parca_agent.CA_BUNDLE_DIR", dirs["bundle"]
+    ), patch("parca_agent.SYSTEM_CERTS_DIR", dirs["certs"]):
+        yield dirs
+
+
+@pytest.fixture(autouse=True)
+def snap_cache(tmp_path):
+    with patch("parca_agent.SNAP_CACHE_DIR", tmp_path / "snap-cache") as snap_cache:
+        yield snap_cache
+
+
+@pytest.fixture
+def snapd(fake_snapd):
+    fake_snapd.add_store_snap(
+        "parca-agent",
+        2587,
+        version="v0.35.3",
+        confinement="classic",
+        services=("parca-agent-svc",),
+    )
+    return fake_snapd
+
+
+def test_install_and_start(snapd):
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set())
+    assert not parca_agent.installed
+    # WHEN the agent is installed and started
+    parca_agent.install()
+    parca_agent.start()
+    # THEN the snap is installed at the target revision, held and running
+    assert parca_agent.installed
+    assert parca_agent.revision == 2587
+    assert parca_agent.running
+    assert parca_agent.version == "v0.35.3"
+    assert snapd.snaps["parca-agent"]["hold"]
+    # AND only the parca-agent snap was ever looked up
+    assert ("GET", "/v2/snaps") not in snapd.requests
+
+
+def test_reconcile_config(snapd):
+    snapd.add_installed_snap("parca-agent", config={"remote-store-address": "old:443"})
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set())
+    # WHEN the config is reconciled
+    parca_agent.reconcile()
+    # THEN the snap is configured with the store config, and restarted once
+    assert snapd.snaps["parca-agent"]["config"] == {
+        "remote-store-address": "parca.example.com:443",
+        "remote-store-insecure": "false",
+    }
+    assert snapd.requests.count(("POST", "/v2/apps")) == 1
+
+
+def test_slow_install(snapd):
+    # GIVEN snapd takes longer to install the snap than the hook waits for
+    snapd.change_polls = 3
+    state = {}
+    ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state, snap_change_timeout=0).install()
+    assert state["pending-change"]["operation"] == "install"
+    # WHEN later hooks follow up on the install
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state)
+    parca_agent.track_change()
+    assert parca_agent.change_in_progress
+    parca_agent.track_change()
+    # THEN the snap is installed and held, once snapd is done
+    assert not parca_agent.change_in_progress
+    assert parca_agent.installed
+    assert snapd.snaps["parca-agent"]["hold"]
+
+
+def test_failed_install(snapd):
+    snapd.fail_change("install", "cannot download snap")
+    with pytest.raises(snap.SnapError, match="cannot download snap"):
+        ParcaAgent("parca-agent", STORE_CONFIG, set()).install()
+    assert "parca-agent" not in snapd.snaps
+
+
+def test_snapd_unavailable(snapd):
+    snapd.fail("snaps", status=500, message="snapd is restarting")
+    with pytest.raises(snap.SnapError):
+        ParcaAgent("parca-agent", STORE_CONFIG, set()).installed
+
+
+def test_snapd_latency_accounted_for(snapd):
+    snapd.add_installed_snap("parca-agent")
+    snapd.latency["snaps"] = 0.03
+    ParcaAgent("parca-agent", STORE_CONFIG, set()).running
+    latency = snap_client.SnapClient().stats["latency"]
+    assert sum(count for bucket, count in latency.items() if bucket >= 0.05) == 1
+
+
+def test_certs_and_config_changes_restart_once(snapd, ca_dirs, caplog):
+    snapd.add_installed_snap("parca-agent", config={"remote-store-address": "old:443"})
+    # GIVEN both the CA certificates and the store config changed
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, {"ca"})
+    # WHEN the agent is reconciled
+    with caplog.at_level("INFO"):
+        parca_agent.reconcile()
+    # THEN both are applied, with a single restart
+    assert (ca_dirs["certs"] / "receive-ca-cert-parca-agent-ca.crt").read_text() == "ca\n\n"
+    assert snapd.snaps["parca-agent"]["config"]["remote-store-address"] == "parca.example.com:443"
+    assert snapd.requests.count(("POST", "/v2/apps")) == 1
+    assert (
+        "CA certificates, store config (remote-store-address, remote-store-insecure)"
+        in caplog.text
+    )
+
+
+def test_restarts_debounced(snapd):
+    snapd.add_installed_snap("parca-agent")
+    state = {}
+    with patch("time.time", return_value=1000):
+        # GIVEN the store config changes twice within the debounce window
+        ParcaAgent(
+            "parca-agent", {"remote-store-address": "a:443"}, set(), state, restart_debounce=30
+        ).reconcile()
+    with patch("time.time", return_value=1020):
+        parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state, restart_debounce=30)
+        parca_agent.reconcile()
+        parca_agent.restart_if_due()
+    # THEN the config is applied, but the restart is pending
+    assert snapd.snaps["parca-agent"]["config"]["remote-store-address"] == "parca.example.com:443"
+    assert parca_agent.restart_pending
+    assert ("POST", "/v2/apps") not in snapd.requests
+
+    # WHEN the window closes
+    with patch("time.time", return_value=1030):
+        ParcaAgent("parca-agent", STORE_CONFIG, set(), state, restart_debounce=30).restart_if_due()
+    # THEN parca-agent is restarted once
+    assert snapd.requests.count(("POST", "/v2/apps")) == 1
+    assert "pending-restart" not in state
+
+
+@patch("subprocess.run")
+def test_ca_bundle_linked_for_parca_agent(run, snapd, ca_dirs):
+    snapd.add_installed_snap("parca-agent", config=STORE_CONFIG)
+    # GIVEN the CA certificates are rotated
+    for certificates in ({"ca1"}, {"ca2"}):
+        ParcaAgent("parca-agent", STORE_CONFIG, certificates).reconcile()
+    # THEN parca-agent trusts the new bundle
+    bundle = ca_dirs["certs"] / "receive-ca-cert-parca-agent-ca.crt"
+    assert bundle.read_text() == "ca2\n\n"
+    assert bundle.resolve().parent == ca_dirs["bundle"]
+    # AND the system bundle is not rebuilt
+    run.assert_not_called()
+
+    # WHEN the certificates are gone
+    ParcaAgent("parca-agent", STORE_CONFIG, set()).reconcile()
+    # THEN so is the bundle
+    assert not any(ca_dirs["certs"].iterdir())
+    assert not any(ca_dirs["bundle"].iterdir())
+
+
+@pytest.mark.parametrize("drift", ("unlinked", "replaced"))
+def test_ca_bundle_link_drift_corrected(snapd, ca_dirs, drift):
+    snapd.add_installed_snap("parca-agent", config=STORE_CONFIG)
+    ParcaAgent("parca-agent", STORE_CONFIG, {"ca"}).reconcile()
+    # GIVEN the bundle's link was removed (by `update-ca-certificates --fresh`), or replaced
+    link = ca_dirs["certs"] / "receive-ca-cert-parca-agent-ca.crt"
+    link.unlink()
+    if drift == "replaced":
+        link.write_text("stale\n\n")
+    # WHEN the agent is reconciled
+    ParcaAgent("parca-agent", STORE_CONFIG, {"ca"}).reconcile()
+    # THEN the bundle is linked again
+    assert link.is_symlink()
+    assert link.read_text() == "ca\n\n"
+    assert [path.name for path in ca_dirs["certs"].iterdir()] == [link.name]
+
+
+@pytest.mark.parametrize("certificates", ({"ca"}, set()))
+@patch("subprocess.run")
+def test_legacy_system_wide_ca_removed(run, snapd, ca_dirs, certificates):
+    snapd.add_installed_snap("parca-agent", config=STORE_CONFIG)
+    # GIVEN an earlier revision of the charm installed the CA system-wide
+    (ca_dirs["legacy"] / "receive-ca-cert-parca-agent-ca.crt").write_text("ca\n\n")
+    # WHEN the agent is reconciled, with or without certificates to trust now
+    ParcaAgent("parca-agent", STORE_CONFIG, certificates).reconcile()
+    # THEN it is taken out of the system trust store, incrementally
+    assert not any(ca_dirs["legacy"].iterdir())
+    run.assert_called_once_with(["update-ca-certificates"])
+
+
+def test_certificates_got_once_when_needed(snapd):
+    snapd.add_installed_snap("parca-agent", config=STORE_CONFIG)
+    get_certificates = MagicMock(return_value={"ca"})
+    # GIVEN no store is configured
+    # WHEN the agent is reconciled
+    ParcaAgent("parca-agent", None, get_certificates).reconcile()
+    # THEN the certificates aren't needed
+    get_certificates.assert_not_called()
+
+    # GIVEN a store is configured
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, get_certificates)
+    # WHEN the agent is reconciled, more than once within a hook
+    parca_agent.reconcile()
+    parca_agent.reconcile()
+    # THEN the certificates are only got once
+    get_certificates.assert_called_once_with()
+
+
+def test_observed_state_from_one_snapd_request(snapd):
+    snapd.add_installed_snap("parca-agent")
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set())
+    # WHEN the state of the agent is observed, and looked up again within the hook
+    requests = len(snapd.requests)
+    observed = parca_agent.observed_state
+    assert parca_agent.observed_state is observed
+    assert parca_agent.running and parca_agent.installed
+    # THEN snapd is only queried once
+    assert len(snapd.requests) - requests == 1
+    assert observed == AgentState(installed=True, revision=2587, version="v0.35.3", active=True)
+
+    # WHEN the agent is changed
+    parca_agent.stop()
+    # THEN it is observed again
+    assert parca_agent.observed_state == AgentState(
+        installed=True, revision=2587, version="v0.35.3", active=False
+    )
+
+
+def test_facts_cached_across_hooks(snapd):
+    snapd.add_installed_snap("parca-agent")
+    state = {}
+    # GIVEN the agent was installed, and held, in an earlier hook which set its version
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state)
+    parca_agent.install()
+    assert parca_agent.version == "v0.35.3"
+    # WHEN later hooks look up its facts
+    for _ in range(2):
+        parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state)
+        assert parca_agent.held
+        assert parca_agent.version == "v0.35.3"
+        # THEN they are served from the cache
+        assert parca_agent.fact_cache_stats == {"hits": 2, "misses": 0}
+    # AND the hold is never looked up through the `snap` CLI
+    assert not snapd.cli_calls
+
+
+def test_facts_expire_and_are_invalidated(snapd):
+    snapd.add_installed_snap("parca-agent")
+    state = {}
+    with patch("time.time", return_value=1000):
+        assert not ParcaAgent("parca-agent", STORE_CONFIG, set(), state).held
+    # WHEN the fact outlives its time to live
+    with patch("time.time", return_value=1000 + 60 * 60):
+        parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state)
+        assert not parca_agent.held
+    # THEN it is looked up again
+    assert parca_agent.fact_cache_stats == {"hits": 0, "misses": 1}
+
+    # WHEN the snap is removed
+    parca_agent.remove()
+    # THEN no facts about it are left
+    assert not state["facts"]
+
+
+def test_install_nothing_to_do(snapd, caplog):
+    snapd.add_installed_snap("parca-agent")
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set())
+    parca_agent.install()
+    # GIVEN the target revision is installed, held and running
+    requests = len(snapd.requests)
+    # WHEN the snap is refreshed and started again
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set())
+    with caplog.at_level("INFO"):
+        parca_agent.refresh()
+    parca_agent.start()
+    # THEN snapd is only asked about the snap, and not to change it
+    assert snapd.requests[requests:] == [("GET", "/v2/snaps/parca-agent")]
+    assert "parca-agent snap refresh plan: nothing to do" in caplog.messages
+
+
+def test_install_holds_installed_snap(snapd, caplog):
+    # GIVEN the target revision is installed, but not held
+    snapd.add_installed_snap("parca-agent")
+    # WHEN the snap is refreshed
+    with caplog.at_level("INFO"):
+        ParcaAgent("parca-agent", STORE_CONFIG, set()).refresh()
+    # THEN it is only held
+    assert "hold" in snapd.snaps["parca-agent"]
+    assert "parca-agent snap refresh plan: hold" in caplog.messages
+
+
+def test_probe(snapd):
+    snapd.add_installed_snap("parca-agent")
+    # GIVEN parca-agent is running, and serving metrics
+    with fake_metrics.serve() as metrics_url:
+        # THEN it passes the health probe
+        assert ParcaAgent("parca-agent", STORE_CONFIG, set()).probe()
+
+    # WHEN it stops serving metrics
+    with patch("parca_agent.METRICS_URL", metrics_url):
+        # THEN it fails the health probe
+        assert not ParcaAgent("parca-agent", STORE_CONFIG, set()).probe(timeout=0.1)
+
+
+def test_unheld_snap_held_again(snapd):
+    snapd.add_installed_snap("parca-agent")
+    state = {}
+    ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state).refresh()
+    # GIVEN the snap was unheld by hand, while the charm still has it cached as held
+    snapd.snaps["parca-agent"].pop("hold")
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state)
+    assert parca_agent.held
+    # WHEN it is ensured to be held
+    parca_agent.ensure_held()
+    # THEN it is held again
+    assert "hold" in snapd.snaps["parca-agent"]
+
+
+def _snap_resource(snapd, tmp_path, tamper=False):
+    snap_file, assert_file = snapd.download("parca-agent", tmp_path)
+    if tamper:
+        snap_file.write_bytes(b"not parca-agent")
+    resource = tmp_path / "parca-agent-snap.tar"
+    with tarfile.open(resource, "w") as tar:
+        tar.add(snap_file, snap_file.name)
+        tar.add(assert_file, assert_file.name)
+    return resource
+
+
+def test_install_from_snap_resource(snapd, snap_cache, tmp_path):
+    resource = _snap_resource(snapd, tmp_path)
+    # WHEN the agent is installed from the snap resource
+    ParcaAgent("parca-agent", STORE_CONFIG, set()).install(resource)
+    # THEN the snap is installed, and held, as if from the store
+    assert snapd.snaps["parca-agent"]["revision"] == "2587"
+    assert "hold" in snapd.snaps["parca-agent"]
+    assert ["install", "--no-wait", str(snap_cache / "parca-agent_2587.snap"), "--classic"] in snapd.cli_calls
+
+    # GIVEN the snap is removed, along with a snap staged for another revision
+    (snap_cache / "parca-agent_2500.snap").write_text("")
+    ParcaAgent("parca-agent", STORE_CONFIG, set()).remove()
+    assert sorted(path.name for path in snap_cache.iterdir()) == [
+        "parca-agent_2587.assert",
+        "parca-agent_2587.snap",
+    ]
+    # AND the resource can't be read anymore
+    resource.write_bytes(b"")
+    # WHEN the agent is installed again
+    ParcaAgent("parca-agent", STORE_CONFIG, set()).install(resource)
+    # THEN the snap unpacked from the resource earlier is reused
+    assert snapd.snaps["parca-agent"]["revision"] == "2587"
+
+
+def test_tampered_snap_resource_rejected(snapd, snap_cache, tmp_path):
+    resource = _snap_resource(snapd, tmp_path, tamper=True)
+    # WHEN the agent is installed from a resource whose snap doesn't match its assertions
+    with pytest.raises(SnapResourceError, match="doesn't match"):
+        ParcaAgent("parca-agent", STORE_CONFIG, set()).install(resource)
+    # THEN nothing is installed, nor kept
+    assert "parca-agent" not in snapd.snaps
+    assert not any(snap_cache.iterdir())
+
+
+def _wait_for_download(state):
+    """Wait for the snap download started in the background to be over, as a later hook would."""
+    status_file = Path(state["pending-download"]["directory"]) / "status"
+    deadline = time.time() + 10
+    while not status_file.exists():
+        assert time.time() < deadline, "the snap download didn't complete"
+        time.sleep(0.01)
+
+
+def test_refresh_prestaged(snapd, snap_cache, caplog):
+    # GIVEN an older revision of parca-agent is running, installed from a staged snap
+    snapd.add_installed_snap("parca-agent", revision=2500)
+    snap_cache.mkdir()
+    for suffix in (".snap", ".assert"):
+        (snap_cache / f"parca-agent_2500{suffix}").write_text("")
+    state = {}
+    # WHEN it is refreshed
+    with caplog.at_level("INFO"):
+        ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state).refresh()
+    # THEN the new revision is downloaded in the background, without refreshing yet
+    assert snapd.snaps["parca-agent"]["revision"] == "2500"
+    assert ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state).download_in_progress
+    # AND once the download is over, a later hook switches over to it
+    _wait_for_download(state)
+    with caplog.at_level("INFO"):
+        parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state)
+        parca_agent.track_change()
+    assert not parca_agent.download_in_progress
+    assert [call[0] for call in snapd.cli_calls] == ["download", "ack", "install"]
+    assert snapd.cli_calls[0][:3] == ["download", "parca-agent", "--revision=2587"]
+    assert ["install", "--no-wait", str(snap_cache / "parca-agent_2587.snap"), "--classic"] in snapd.cli_calls
+    assert snapd.snaps["parca-agent"]["revision"] == "2587"
+    assert "parca-agent snap refresh plan: download revision 2587, " in caplog.text
+    # AND how long the switch-over took is reported
+    assert parca_agent.last_switch_over["from"] == 2500
+    assert parca_agent.last_switch_over["to"] == 2587
+    assert parca_agent.last_switch_over["duration"] >= 0
+    # AND only the snap staged for the new revision is kept
+    assert sorted(path.name for path in snap_cache.iterdir()) == [
+        "parca-agent_2587.assert",
+        "parca-agent_2587.snap",
+    ]
+
+
+def test_refresh_from_store_if_download_fails(snapd, snap_cache):
+    snapd.add_installed_snap("parca-agent", revision=2500)
+    # GIVEN the new revision can't be downloaded ahead of the refresh
+    with patch("parca_agent._start_download", side_effect=snap.SnapError("no network")):
+        # WHEN parca-agent is refreshed
+        parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set())
+        parca_agent.refresh()
+    # THEN it is refreshed in place, from the store
+    assert snapd.snaps["parca-agent"]["revision"] == "2587"
+    assert not any(call[:1] == ["install"] for call in snapd.cli_calls)
+    assert parca_agent.last_switch_over is None
+
+
+def test_refresh_from_store_corrects_confinement(snapd, snap_cache):
+    # GIVEN the snap was installed with strict confinement
+    snapd.add_installed_snap("parca-agent", revision=2500)
+    snapd.snaps["parca-agent"]["confinement"] = "strict"
+    # WHEN parca-agent is refreshed from the store
+    with patch("parca_agent._start_download", side_effect=snap.SnapError("no network")):
+        ParcaAgent("parca-agent", STORE_CONFIG, set()).refresh()
+    # THEN it is refreshed to the classic revision, as consented to
+    assert snapd.snaps["parca-agent"]["revision"] == "2587"
+    assert snapd.snaps["parca-agent"]["confinement"] == "classic"
+
+
+@pytest.mark.parametrize("timed_out", (False, True))
+def test_refresh_from_store_if_background_download_fails(snapd, snap_cache, timed_out):
+    snapd.add_installed_snap("parca-agent", revision=2500)
+    state = {}
+    ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state).refresh()
+    directory = Path(state["pending-download"]["directory"])
+    _wait_for_download(state)
+    # GIVEN the download in the background failed, or never completed
+    if timed_out:
+        (directory / "status").unlink()
+        state["pending-download"]["since"] -= parca_agent_module.DOWNLOAD_TIMEOUT
+    else:
+        (directory / "status").write_text("1\n")
+    # WHEN a later hook follows up on it
+    parca_agent = ParcaAgent("parca-agent", STORE_CONFIG, set(), state=state)
+    parca_agent.track_change()
+    # THEN it is refreshed in place, from the store
+    assert snapd.snaps["parca-agent"]["revision"] == "2587"
+    assert not any(call[:1] == ["install"] for call in snapd.cli_calls)
+    assert not parca_agent.download_in_progress
+    assert not directory.exists()
@@ -0,0 +1,72 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+from unittest.mock import patch
+
+import pytest
+from charms.operator_libs_linux.v1 import snap
+
+import snap_client
+
+
+@pytest.fixture
+def snapd(fake_snapd):
+    fake_snapd.add_store_snap("parca-agent", 2587)
+    fake_snapd.add_installed_snap("parca-agent", revision=2587)
+    return fake_snapd
+
+
+def test_clients_share_keep_alive_connection(snapd):
+    # GIVEN two clients talking to the same socket
+    client, other_client = snap_client.SnapClient(), snap_client.SnapClient()
+    # WHEN they make several requests
+    assert client.get_installed_snap("parca-agent")["revision"] == "2587"
+    change_id = other_client.post_snap("parca-agent", "hold")
+    assert client.get_change(change_id)["ready"]
+    # THEN a single connection to snapd is opened
+    assert snapd.connections == 1
+    # AND the requests are accounted for
+    assert client.stats["requests"] == 3
+    assert sum(client.stats["latency"].values()) == 3
+
+
+def test_client_reconnects_when_snapd_closes_connection(snapd):
+    client = snap_client.SnapClient()
+    client.get_installed_snap("parca-agent")
+    # GIVEN snapd dropped the idle connection
+    pool = snap_client._ConnectionPool.get(snap_client.SNAPD_SOCKET)
+    pool._connection.sock.shutdown(2)
+    # THEN the next request, even a change, transparently goes over a new connection
+    client.post_snap("parca-agent", "hold")
+    assert snapd.snap_actions == [("parca-agent", "hold")]
+    assert snapd.connections == 2
+
+
+def _drop_connection_once():
+    """Have snapd drop the connection the next request goes over, once it has handled it."""
+    getresponse = snap_client._UnixSocketConnection.getresponse
+    dropped = []
+
+    def drop(connection):
+        response = getresponse(connection)
+        if not dropped:
+            dropped.append(response.read())
+            raise ConnectionResetError("connection reset by peer")
+        return response
+
+    return patch.object(snap_client._UnixSocketConnection, "getresponse", drop)
+
+
+def test_client_only_retries_get_when_snapd_drops_connection(snapd):
+    client = snap_client.SnapClient()
+    client.get_installed_snap("parca-agent")
+    # GIVEN snapd drops the connection as it answers a GET
+    with _drop_connection_once():
+        # THEN the GET is retried, over a new connection
+        assert client.get_installed_snap("parca-agent")["revision"] == "2587"
+    # GIVEN snapd drops the connection as it answers a POST
+    with _drop_connection_once():
+        # THEN the POST isn't retried, as snapd acted on it already
+        with pytest.raises(snap.SnapAPIError):
+            client.post_snap("parca-agent", "hold")
+    assert snapd.snap_actions == [("parca-agent", "hold")]
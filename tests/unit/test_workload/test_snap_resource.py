@@ -0,0 +1,33 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+import tarfile
+
+from hook_scenarios import STORE_RELATION, machine
+from ops.testing import ActiveStatus, Context, Resource, State
+
+from charm import ParcaAgentOperatorCharm
+
+
+def test_install_from_attached_snap_resource(tmp_path):
+    context = Context(ParcaAgentOperatorCharm)
+    with machine(tmp_path) as m:
+        # GIVEN the snap and its assertions are attached as a resource
+        downloads = tmp_path / "downloads"
+        downloads.mkdir()
+        resource = tmp_path / "snap.tar"
+        with tarfile.open(resource, "w") as tar:
+            for path in m.snapd.download("parca-agent", downloads):
+                tar.add(path, path.name)
+        state = State(
+            leader=True,
+            relations={STORE_RELATION},
+            resources={Resource(name="parca-agent-snap", path=resource)},
+        )
+        # WHEN the charm is installed
+        state_out = context.run(context.on.install(), state)
+
+    # THEN parca-agent is installed from the resource, not the store
+    assert any(call[:1] == ["install"] for call in m.snapd.cli_calls)
+    assert ("parca-agent", "install") not in m.snapd.snap_actions
+    assert ("parca-agent", "refresh") not in m.snapd.snap_actions
+    assert state_out.unit_status == ActiveStatus("")
@@ -0,0 +1,70 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+# Most of the cost of a hook is in the processes it spawns: subprocesses run by the charm, and
+# hook tools invoked by ops. Guard each event against new spawns on its path.
+import pytest
+from call_counter import count_spawns
+from hook_scenarios import SCENARIOS, machine
+from ops.testing import Context, State
+
+from charm import ParcaAgentOperatorCharm
+
+# event: (max subprocesses, max hook tools)
+# Every log record is a juju-log hook tool. None of the scenarios relate to a COS agent, so
+# the charm isn't traced. Unless settled, a scenario is the first hook of its unit: it runs
+# `parca-agent --version`, which later hooks find cached for the same snap revision.
+BUDGETS = {
+    "install": (1, 16),
+    "start": (1, 16),
+    "upgrade-charm": (2, 18),
+    "update-status": (0, 12),
+    "parca-store-endpoint-relation-changed": (1, 16),
+    "receive-ca-cert-relation-changed": (1, 19),
+    "remove": (0, 14),
+}
+
+
+def test_every_scenario_has_a_budget():
+    assert BUDGETS.keys() == SCENARIOS.keys()
+
+
+@pytest.mark.parametrize("event_name", SCENARIOS)
+def test_spawn_budget(tmp_path, event_name):
+    scenario = SCENARIOS[event_name]
+    context = Context(ParcaAgentOperatorCharm)
+    with machine(tmp_path) as m:
+        state = State(leader=True, relations=scenario.relations, resources=m.resources)
+        if scenario.settled:
+            scenario.setup(m)
+            state = context.run(scenario.event(context.on), state)
+        scenario.setup(m)
+        # WHEN the event is processed
+        with count_spawns() as spawns:
+            context.run(scenario.event(context.on), state)
+
+    # THEN no more processes are spawned than budgeted for
+    max_subprocesses, max_hook_tools = BUDGETS[event_name]
+    assert spawns.subprocesses <= max_subprocesses, dict(spawns)
+    assert spawns.hook_tools <= max_hook_tools, dict(spawns)
+
+
+def test_settled_unit_sets_nothing_again(tmp_path):
+    scenario = SCENARIOS["start"]
+    context = Context(ParcaAgentOperatorCharm)
+    with machine(tmp_path) as m:
+        # GIVEN the unit already set its status, workload version and ports
+        scenario.setup(m)
+        state = context.run(
+            scenario.event(context.on),
+            State(leader=True, relations=scenario.relations, resources=m.resources),
+        )
+        # WHEN the same event is processed again
+        with count_spawns() as spawns:
+            state_out = context.run(scenario.event(context.on), state)
+
+    # THEN none of them is set again
+    for hook_tool in ("status-set", "application-version-set", "opened-ports", "open-port"):
+        assert not spawns[f"hook-tool:{hook_tool}"], dict(spawns)
+    assert state_out.unit_status == state.unit_status
+    assert state_out.opened_ports == state.opened_ports